@@ -5,13 +5,16 @@
 # --------------------------------------------------------------------------
 from __future__ import annotations
 
+import functools
+import os
 import uuid
+from collections import Counter, defaultdict
 from pathlib import Path
 
 import numpy as np
 import onnx
 from onnx import TensorProto
-from onnx.helper import float32_to_float8e4m3, np_dtype_to_tensor_dtype
+from onnx.helper import np_dtype_to_tensor_dtype
 from onnx.numpy_helper import float8e4m3_to_float32
 from onnx.reference import ReferenceEvaluator
 from onnx.reference import ops as onnx_ops
@@ -35,6 +38,73 @@ if onnx_recent_enough:
         onnx_recent_enough = False
 
 
+def float32_to_float8e4m3_array(x: np.ndarray) -> np.ndarray:
+    """
+    Vectorized version of :func:`onnx.helper.float32_to_float8e4m3` (fn=True, uz=False, saturate=True).
+    Values are rounded to nearest even, out of range values and infinities saturate to +/-448,
+    NaN is converted into 0x7F.
+    """
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    b = x.view(np.uint32)
+    sign = ((b >> 24) & 0x80).astype(np.uint8)
+    a = b & 0x7FFFFFFF
+    # Normal numbers: rounds the mantissa to 3 bits, a carry propagates into the exponent.
+    # The exponent is rebiased from 127 to 7.
+    normal = ((a + 0x7FFFF + ((a >> 20) & 1)) >> 20).astype(np.int32) - ((127 - 7) << 3)
+    np.clip(normal, 0, 0x7E, out=normal)
+    # Subnormal numbers (|x| < 2^-6) are multiples of 2^-9, rounding up to 8 gives the smallest normal number.
+    # They are only computed on the masked elements so that large values, infinities and NaN are never scaled.
+    is_subnormal = a < 0x3C800000
+    code = normal
+    code[is_subnormal] = np.rint(np.abs(x[is_subnormal]) * np.float32(512)).astype(np.int32)
+    code[a > 0x7F800000] = 0x7F
+    return (code.astype(np.uint8) | sign).view(float8e4m3fn)
+
+
+def round_clip_cast(y: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """
+    Rounds *y* to the nearest integer (ties to even) and saturates it into *dtype* (uint8 or int8).
+    *y* is clipped inplace, rounding and casting are done in the same pass.
+    """
+    if dtype == np.uint8:
+        np.clip(y, 0, 255, out=y)
+    elif dtype == np.int8:
+        np.clip(y, -128, 127, out=y)
+    else:
+        raise ValueError(f"Unexpected dtype={dtype}, it should be uint8 or int8.")
+    # The bounds are integers, clipping before rounding gives the same result.
+    return np.rint(y, out=np.empty(y.shape, dtype=dtype), casting="unsafe")
+
+
+def _dequantized_matmul(A, a_scale, a_zero_point, B, b_scale, b_zero_point) -> np.ndarray:
+    """
+    Returns ``((A - a_zero_point) * a_scale) @ ((B - b_zero_point) * b_scale)`` in float32.
+    """
+    # astype copies the inputs, the zero points can then be removed inplace.
+    a_shifted = A.astype(np.float32)
+    a_shifted -= a_zero_point
+    b_shifted = B.astype(np.float32)
+    b_shifted -= b_zero_point
+    if np.size(a_scale) == 1 and np.ndim(b_scale) <= 1:
+        # A per-tensor scale on A and a per-tensor or per-column scale on B can be applied on the result,
+        # it saves one pass over each input.
+        y = a_shifted @ b_shifted
+        y *= a_scale * b_scale
+        return y
+    a_shifted *= a_scale
+    b_shifted *= b_scale
+    return a_shifted @ b_shifted
+
+
+# The custom float 8 dtypes only differ by the name of their unique field.
+_F8_DTYPE_TO_TENSOR_TYPE = {
+    np.dtype(float8e4m3fn): TensorProto.FLOAT8E4M3FN,
+    np.dtype(float8e4m3fnuz): TensorProto.FLOAT8E4M3FNUZ,
+    np.dtype(float8e5m2): TensorProto.FLOAT8E5M2,
+    np.dtype(float8e5m2fnuz): TensorProto.FLOAT8E5M2FNUZ,
+}
+
+
 class QOpRun(OpRun):
     op_domain = "com.microsoft"
 
@@ -46,14 +116,9 @@ class QOpRun(OpRun):
     }
 
     def get_tensor_type(self, tensor: np.ndarray) -> int:
-        if tensor.dtype == float8e4m3fn and tensor.dtype.descr[0][0] == "e4m3fn":
-            return TensorProto.FLOAT8E4M3FN
-        if tensor.dtype == float8e4m3fnuz and tensor.dtype.descr[0][0] == "e4m3fnuz":
-            return TensorProto.FLOAT8E4M3FNUZ
-        if tensor.dtype == float8e5m2 and tensor.dtype.descr[0][0] == "e5m2":
-            return TensorProto.FLOAT8E5M2
-        if tensor.dtype == float8e5m2fnuz and tensor.dtype.descr[0][0] == "e5m2fnuz":
-            return TensorProto.FLOAT8E5M2FNUZ
+        tensor_type = _F8_DTYPE_TO_TENSOR_TYPE.get(tensor.dtype)
+        if tensor_type is not None:
+            return tensor_type
         return np_dtype_to_tensor_dtype(tensor.dtype)
 
 
@@ -78,17 +143,20 @@ class QGemm(QOpRun):
         if transB:
             B = B.T
 
+        # Scales are converted once, they are used by every branch.
+        a_scale = np.float32(a_scale)
+        b_scale = np.float32(b_scale)
+        alpha = np.float32(alpha)
+        if y_scale is not None:
+            y_scale = np.float32(y_scale)
+
         a_type = self.get_tensor_type(a_zero_point)
         b_type = self.get_tensor_type(b_zero_point)
         y_type = self.get_tensor_type(y_zero_point)
         if a_type == TensorProto.FLOAT8E4M3FN and b_type == TensorProto.FLOAT8E4M3FN:
-            a_scaled = (float8e4m3_to_float32(A).astype(float) - float8e4m3_to_float32(a_zero_point)) * np.float32(
-                a_scale
-            )
-            b_scaled = (float8e4m3_to_float32(B).astype(float) - float8e4m3_to_float32(b_zero_point)) * np.float32(
-                b_scale
-            )
-            y = a_scaled @ b_scaled * np.float32(alpha)
+            a_scaled = (float8e4m3_to_float32(A) - float8e4m3_to_float32(a_zero_point)) * a_scale
+            b_scaled = (float8e4m3_to_float32(B) - float8e4m3_to_float32(b_zero_point)) * b_scale
+            y = a_scaled @ b_scaled * alpha
             if C is not None:
                 dtype = self.get_tensor_type(C)
                 if dtype not in (TensorProto.FLOAT, TensorProto.FLOAT16):
@@ -98,28 +166,19 @@ class QGemm(QOpRun):
                 y /= y_scale
             if y_zero_point is not None:
                 y += float8e4m3_to_float32(y_zero_point)
-                ry = y.ravel()
-
-                fy = np.empty(ry.shape, dtype=float8e4m3fn)
-                for i in range(fy.shape[0]):
-                    el = float32_to_float8e4m3(ry[i])  # type: ignore[assignment]
-                    fy[i] = el
-                y = fy.reshape(y.shape)
+                y = float32_to_float8e4m3_array(y)
             else:
                 raise NotImplementedError("y_zero_point is not empty. QGemm is not implemented in that case.")
             return (y,)
         elif a_type in self.f8_types or b_type in self.f8_types or y_type in self.f8_types:
             raise NotImplementedError(f"QGemm not implemented for zero_types {a_type}, {b_type}, {y_type}.")
         else:
-            if TensorProto.FLOAT8E4M3FN in {a_type, b_type, y_type}:
-                raise TypeError(f"Unexpected type for A: {dtype}, B:{dtype} or Y:{dtype}.")
-            a_scaled = (A.astype(float) - a_zero_point) * np.float32(a_scale)
-            b_scaled = (B.astype(float) - b_zero_point) * np.float32(b_scale)
-            y = a_scaled @ b_scaled * np.float32(alpha)
+            y = _dequantized_matmul(A, a_scale, a_zero_point, B, b_scale, b_zero_point)
+            y *= alpha
             if C is not None:
-                y += C * np.float32(a_scale) * np.float32(b_scale)
+                y += C.astype(np.float32) * (a_scale * b_scale)
             if y_scale is not None:
-                y /= np.float32(y_scale)
+                y /= y_scale
             if y_zero_point is not None:
                 y += y_zero_point
 
@@ -130,15 +189,7 @@ class QGemm(QOpRun):
             else:
                 dtype = A.dtype
 
-            y = np.rint(y)
-            if dtype == np.uint8:
-                y = np.clip(y, 0, 255)
-            elif dtype == np.int8:
-                y = np.clip(y, -128, 127)
-            else:
-                raise ValueError(f"Unexpected dtype={dtype}, it should be uint8 or int8.")
-
-            return (y.astype(dtype),)
+            return (round_clip_cast(y, dtype),)
 
 
 class QLinearMatMul(QOpRun):
@@ -153,41 +204,33 @@ class QLinearMatMul(QOpRun):
         y_scale=None,
         y_zero_point=None,
     ):
+        # Scales are converted once, they are used by every branch.
+        a_scale = np.float32(a_scale)
+        b_scale = np.float32(b_scale)
+        if y_scale is not None:
+            y_scale = np.float32(y_scale)
+
         a_type = self.get_tensor_type(a_zero_point)
         b_type = self.get_tensor_type(b_zero_point)
         y_type = self.get_tensor_type(y_zero_point)
         if a_type == TensorProto.FLOAT8E4M3FN and b_type == TensorProto.FLOAT8E4M3FN:
-            a_scaled = (float8e4m3_to_float32(A).astype(float) - float8e4m3_to_float32(a_zero_point)) * np.float32(
-                a_scale
-            )
-            b_scaled = (float8e4m3_to_float32(B).astype(float) - float8e4m3_to_float32(b_zero_point)) * np.float32(
-                b_scale
-            )
+            a_scaled = (float8e4m3_to_float32(A) - float8e4m3_to_float32(a_zero_point)) * a_scale
+            b_scaled = (float8e4m3_to_float32(B) - float8e4m3_to_float32(b_zero_point)) * b_scale
             y = a_scaled @ b_scaled
             if y_scale is not None:
                 y /= y_scale
             if y_zero_point is not None:
                 y += float8e4m3_to_float32(y_zero_point)
-                ry = y.ravel()
-
-                fy = np.empty(ry.shape, dtype=float8e4m3fn)
-                for i in range(fy.shape[0]):
-                    el = float32_to_float8e4m3(ry[i])  # type: ignore[assignment]
-                    fy[i] = el
-                y = fy.reshape(y.shape)
+                y = float32_to_float8e4m3_array(y)
             else:
                 raise NotImplementedError("y_zero_point is not empty. QLinearMatMul is not implemented in that case.")
             return (y,)
         elif a_type in self.f8_types or b_type in self.f8_types or y_type in self.f8_types:
             raise NotImplementedError(f"QLinearMatMul not implemented for zero_types {a_type}, {b_type}, {y_type}.")
         else:
-            if TensorProto.FLOAT8E4M3FN in {a_type, b_type, y_type}:
-                raise TypeError(f"Unexpected type for A: {a_type}, B:{b_type} or Y:{y_type}.")
-            a_scaled = (A.astype(float) - a_zero_point) * np.float32(a_scale)
-            b_scaled = (B.astype(float) - b_zero_point) * np.float32(b_scale)
-            y = a_scaled @ b_scaled
+            y = _dequantized_matmul(A, a_scale, a_zero_point, B, b_scale, b_zero_point)
             if y_scale is not None:
-                y /= np.float32(y_scale)
+                y /= y_scale
             if y_zero_point is not None:
                 y += y_zero_point
 
@@ -198,15 +241,7 @@ class QLinearMatMul(QOpRun):
             else:
                 dtype = A.dtype
 
-            y = np.rint(y)
-            if dtype == np.uint8:
-                y = np.clip(y, 0, 255)
-            elif dtype == np.int8:
-                y = np.clip(y, -128, 127)
-            else:
-                raise ValueError(f"Unexpected dtype={dtype}, it should be uint8 or int8.")
-
-            return (y.astype(dtype),)
+            return (round_clip_cast(y, dtype),)
 
 
 class TestDataFeeds(CalibrationDataReader):
@@ -224,19 +259,28 @@ class TestDataFeeds(CalibrationDataReader):
         self.iter_next = iter(self.data_feeds)
 
 
+def _default_rng(seed=None):
+    """
+    numpy.random.Generator seeded with seed, or from the global numpy random state if seed is None,
+    so that the callers which only call np.random.seed stay reproducible
+    """
+    if seed is None:
+        seed = np.random.randint(2**32, dtype=np.int64)
+    return np.random.default_rng(seed)
+
+
 def input_feeds_neg_one_zero_one(n, name2shape, seed=None):
     """
     randomize n feed according to shape, its values are from -1, 0, and 1
     """
-    if seed is not None:
-        np.random.seed(seed)
+    rng = _default_rng(seed)
 
     input_data_list = []
     for _i in range(n):
         inputs = {}
         for name, shape in name2shape.items():
-            inputs.update({name: np.random.randint(-1, 2, shape).astype(np.float32)})
-        input_data_list.extend([inputs])
+            inputs[name] = rng.integers(-1, 2, size=shape, dtype=np.int8).astype(np.float32)
+        input_data_list.append(inputs)
     dr = TestDataFeeds(input_data_list)
     return dr
 
@@ -245,15 +289,14 @@ def input_feeds_neg_one_zero_one_list(n, name2shape, seed=None):
     """
     randomize n feed according to shape, its values are from -1, 0, and 1
     """
-    if seed is not None:
-        np.random.seed(seed)
+    rng = _default_rng(seed)
 
     input_data_list = []
     for _i in range(n):
         inputs = {}
         for name, shape in name2shape.items():
-            inputs.update({name: np.random.randint(-1, 2, shape).astype(np.float32)})
-        input_data_list.extend([inputs])
+            inputs[name] = rng.integers(-1, 2, size=shape, dtype=np.int8).astype(np.float32)
+        input_data_list.append(inputs)
     return input_data_list
 
 
@@ -273,17 +316,16 @@ class GenerateCalibrationData(CalibrationDataReader):
     def __len__(self):
         return len(self.calibration_dataset)
 
+    def _prepare_input(self, index, input_data):
+        input_data = input_data.reshape(self.input_shapes[index])
+        if self.inputs_conv_channel_last is not None and self.input_nodes[index] in self.inputs_conv_channel_last:
+            input_data = np.moveaxis(input_data, 1, -1)
+        return input_data
+
     def get_next(self):
-        feed_dict = {}
         inp = next(self.calibration_dataset, None)
         if inp is not None:
-            for i in range(len(self.input_nodes)):
-                input_data = inp[i].reshape(self.input_shapes[i])
-                if self.inputs_conv_channel_last is not None and self.input_nodes[i] in self.inputs_conv_channel_last:
-                    input_data = np.moveaxis(input_data, 1, -1)
-                dict_item = {self.input_nodes[i]: input_data}
-                feed_dict.update(dict_item)
-            return feed_dict
+            return {input_node: self._prepare_input(i, inp[i]) for i, input_node in enumerate(self.input_nodes)}
         else:
             return None
 
@@ -355,9 +397,24 @@ class StridedDataReader(GenerateCalibrationData):
         self.enum_data_dicts = iter([])
 
 
+@functools.lru_cache(maxsize=32)
+def _load_model_cached(model_path: str, mtime_ns: int, size: int, load_external_data: bool) -> onnx.ModelProto:
+    return onnx.load(model_path, load_external_data=load_external_data)
+
+
+def load_model_cached(model_path: str | Path, load_external_data: bool = True) -> onnx.ModelProto:
+    """
+    Loads a model and caches the result as long as the file is not modified.
+    The returned model is shared between callers and must not be modified.
+    Checks only looking at the graph structure should set *load_external_data* to False.
+    """
+    stat = os.stat(model_path)
+    return _load_model_cached(str(model_path), stat.st_mtime_ns, stat.st_size, load_external_data)
+
+
 def check_op_type_order(testcase, model_to_check, ops):
     if isinstance(model_to_check, str):
-        model = onnx.load(model_to_check)
+        model = load_model_cached(model_to_check, load_external_data=False)
     elif isinstance(model_to_check, onnx.ModelProto):
         model = model_to_check
 
@@ -371,13 +428,8 @@ def check_op_type_order(testcase, model_to_check, ops):
 
 
 def check_op_type_count(testcase, model_path, **kwargs):
-    model = onnx.load(Path(model_path))
-    optype2count = {}
-    for op_type in kwargs:
-        optype2count[op_type] = 0
-    for node in model.graph.node:
-        if node.op_type in optype2count:
-            optype2count[node.op_type] += 1
+    model = load_model_cached(model_path, load_external_data=False)
+    optype2count = Counter(node.op_type for node in model.graph.node)
 
     for op_type, value in kwargs.items():
         try:
@@ -390,20 +442,21 @@ def check_op_type_count(testcase, model_path, **kwargs):
             from onnx_array_api.plotting.text_plot import onnx_simple_text_plot  # noqa: PLC0415
 
             raise AssertionError(
-                f"Assert failed:\noptype={optype2count}\nkwargs={kwargs}\n{onnx_simple_text_plot(model)}"
+                f"Assert failed:\noptype={dict(optype2count)}\nkwargs={kwargs}\n{onnx_simple_text_plot(model)}"
             ) from e
 
 
-def check_sign_f8_quantization(model_path_origin, model_path_to_check):
+def check_sign_f8_quantization(model_path_origin, model_path_to_check, model_origin=None, model_f8=None):
     """
     Quantization to float 8 type does not change the sign as zero_point is always null.
     This function checks that the quantized parameters did not change.
+    *model_origin* and *model_f8* can be given to avoid loading the models again.
     """
-    with open(model_path_origin, "rb") as f:
-        model = onnx.load(f)
-    names = {init.name: init for init in model.graph.initializer}
-    with open(model_path_to_check, "rb") as f:
-        model_f8 = onnx.load(f)
+    if model_origin is None:
+        model_origin = load_model_cached(model_path_origin)
+    names = {init.name: init for init in model_origin.graph.initializer}
+    if model_f8 is None:
+        model_f8 = load_model_cached(model_path_to_check)
     names_f8 = {init.name: init for init in model_f8.graph.initializer}
     for init in model_f8.graph.initializer:
         if not init.name.endswith("_quantized"):
@@ -429,15 +482,20 @@ def check_sign_f8_quantization(model_path_origin, model_path_to_check):
             if len(zero) != 0:
                 raise AssertionError(f"No zero is expected but has {zero}.")
 
-        expected_sign = onnx.numpy_helper.to_array(names[name]) >= 0
-
         if "bias" in init.name:
             if init.data_type >= 17:
                 raise AssertionError(f"bias {init.name!r} should be float 16 not {init.data_type}.")
             continue
         if init.data_type < 17:
             raise AssertionError(f"Initializer {init.name!r} not a float 8 type.")
-        raw = np.array([int(i) for i in init.raw_data])
+
+        origin = names[name]
+        if origin.data_type == TensorProto.FLOAT and origin.raw_data:
+            # Only the sign bit is needed, -0.0 (0x80000000) is considered as positive like with `>= 0`.
+            expected_sign = np.frombuffer(origin.raw_data, dtype="<u4") <= 0x80000000
+        else:
+            expected_sign = onnx.numpy_helper.to_array(origin) >= 0
+        raw = np.frombuffer(init.raw_data, dtype=np.uint8)
         got_sign = raw <= 128
         try:
             np.testing.assert_allclose(expected_sign.ravel(), got_sign)
@@ -469,26 +527,27 @@ def check_model_correctness(
     dynamic=False,
     is_gemm=False,
     op_matmul=False,
+    dump_optimized=False,
 ):
     if providers is None:
         providers = ["CPUExecutionProvider"]
     sess_options = onnxruntime.SessionOptions()
     sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
-    sess_options.optimized_model_filepath = model_path_to_check + ".optimized.onnx"
+    if dump_optimized:
+        # Saves the optimized model next to the checked one, useful to debug a failing test.
+        sess_options.optimized_model_filepath = model_path_to_check + ".optimized.onnx"
     origin_sess = onnxruntime.InferenceSession(model_path_origin, sess_options=sess_options, providers=providers)
     origin_results = origin_sess.run(None, inputs)
 
-    with open(model_path_origin, "rb") as f:
-        model_onnx = onnx.load(f)
+    model_onnx = load_model_cached(model_path_origin)
     ops_set = {node.op_type for node in model_onnx.graph.node}
     check_reference_evaluator = not (ops_set & {"EmbedLayerNormalization", "Conv", "Attention", "Transpose"})
     check_target_evaluator = False
 
-    with open(model_path_to_check, "rb") as f:
-        model_check = onnx.load(f)
+    model_check = load_model_cached(model_path_to_check)
 
     if check_reference_evaluator and onnx_recent_enough:
-        ref = ReferenceEvaluator(model_path_origin)
+        ref = ReferenceEvaluator(model_onnx)
         ref_origin_results = ref.run(None, inputs)
         for idx, ref_output in enumerate(origin_results):
             output = ref_origin_results[idx]
@@ -502,11 +561,7 @@ def check_model_correctness(
 
     # Verifies the shapes in the quantized model.
     if is_gemm:
-        expected_shapes = {}
-        with open(model_path_origin, "rb") as f:
-            model = onnx.load(f)
-            for init in model.graph.initializer:
-                expected_shapes[init.name] = tuple(init.dims)
+        expected_shapes = {init.name: tuple(init.dims) for init in model_onnx.graph.initializer}
         checked = 0
         f8_quantization = False
         for init in model_check.graph.initializer:
@@ -535,7 +590,9 @@ def check_model_correctness(
                 f"names={[init.name for init in model_check.graph.initializer]}."
             )
         if f8_quantization:
-            check_sign_f8_quantization(model_path_origin, model_path_to_check)
+            check_sign_f8_quantization(
+                model_path_origin, model_path_to_check, model_origin=model_onnx, model_f8=model_check
+            )
 
     # Verifies the expected outputs.
     if check_target_evaluator and onnx_recent_enough:
@@ -613,11 +670,19 @@ def check_model_correctness(
 
 
 def check_op_nodes(testcase, model_path, node_checker):
-    model = onnx.load(Path(model_path))
+    model = onnx.load(Path(model_path), load_external_data=False)
     for node in model.graph.node:
         testcase.assertTrue(node_checker(node))
 
 
+@functools.lru_cache(maxsize=16)
+def _infer_shapes_cached(serialized_model: bytes) -> onnx.ModelProto:
+    # The returned model is shared between callers and must not be modified.
+    model = onnx.ModelProto()
+    model.ParseFromString(serialized_model)
+    return onnx.shape_inference.infer_shapes(model)
+
+
 def check_qtype_by_node_type(testcase, model_to_check, check_list):
     if isinstance(model_to_check, str):
         model = onnx.load(model_to_check)
@@ -626,7 +691,7 @@ def check_qtype_by_node_type(testcase, model_to_check, check_list):
     # NOTE: ONNX shape inference does not work on MS domain nodes.
     # Therefore, this function cannot currently be used for graphs that contain ops such as
     # com.microsoft.QuantizeLinear, which support 16-bit quantization.
-    model = onnx.shape_inference.infer_shapes(model)
+    model = _infer_shapes_cached(model.SerializeToString())
     value_infos = {vi.name: vi for vi in model.graph.value_info}
     value_infos.update({ot.name: ot for ot in model.graph.output})
     value_infos.update({it.name: it for it in model.graph.input})
@@ -656,16 +721,22 @@ def create_clip_node(input_name, output_name, node_name, initializers, min_value
     clip_inputs = [input_name, clip_min_name, clip_max_name]
     clip_outputs = [output_name]
     clip_name = node_name
-    initializers.append(onnx.numpy_helper.from_array(np.array(min_value, dtype=np.float32), name=clip_min_name))
-    initializers.append(onnx.numpy_helper.from_array(np.array(max_value, dtype=np.float32), name=clip_max_name))
+    initializers.append(onnx.helper.make_tensor(clip_min_name, TensorProto.FLOAT, [], [min_value]))
+    initializers.append(onnx.helper.make_tensor(clip_max_name, TensorProto.FLOAT, [], [max_value]))
     return onnx.helper.make_node("Clip", clip_inputs, clip_outputs, name=clip_name)
 
 
-def generate_random_initializer(initializer_name, tensor_shape, tensor_dtype, mean=0.0, dev=0.3):
+def generate_random_initializer(initializer_name, tensor_shape, tensor_dtype, mean=0.0, dev=0.3, rng=None):
     """
     Helper function to generate initializers for test inputs
+    parameter rng: optional numpy.random.Generator, one seeded from the global numpy random state is created if None
     """
-    tensor = np.random.normal(mean, dev, tensor_shape).astype(tensor_dtype)
+    if rng is None:
+        rng = _default_rng()
+    tensor = rng.standard_normal(tensor_shape, dtype=np.float32)
+    tensor *= np.float32(dev)
+    tensor += np.float32(mean)
+    tensor = tensor.astype(tensor_dtype, copy=False)
     init = onnx.numpy_helper.from_array(tensor, initializer_name)
     return init
 
@@ -678,19 +749,15 @@ def get_tensor_consumers_and_producers(
       - consumers: maps a tensor name to the list of nodes that have that tensor as an input.
       - producers: maps a tensor name to the node that generates this tensor as an output.
     """
-    consumers: dict[str, list[onnx.NodeProto]] = {}
+    consumers: defaultdict[str, list[onnx.NodeProto]] = defaultdict(list)
     producers: dict[str, onnx.NodeProto] = {}
     for node in model.graph.node:
-        # Iterate through node's inputs to build the consumers dictionary.
-        for input_name in node.input:
-            if input_name:
-                if input_name not in consumers:
-                    consumers[input_name] = []
-
-                consumers[input_name].append(node)
+        # Iterate through node's inputs to build the consumers dictionary (empty names are optional inputs).
+        for input_name in filter(None, node.input):
+            consumers[input_name].append(node)
 
         # Iterate through node's outputs to build the producers dictionary.
         for output_name in node.output:
             producers[output_name] = node
 
-    return (consumers, producers)
+    return (dict(consumers), producers)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+import unittest
+import warnings
+
+import numpy
+from onnx import helper
+from op_test_utils import float32_to_float8e4m3_array
+
+
+@unittest.skipIf(not hasattr(helper, "float32_to_float8e4m3"), reason="onnx.helper.float32_to_float8e4m3 is missing")
+class TestOpTestUtils(unittest.TestCase):
+    def test_float32_to_float8e4m3_array(self):
+        # All the float16 values, which include infinities, NaN, the subnormal ties at 2^-10 and 3 * 2^-10 and the
+        # saturation around +/-448 and +/-464, and float32 values beyond the float16 range.
+        x = numpy.arange(65536, dtype=numpy.uint16).view(numpy.float16).astype(numpy.float32)
+        extra = numpy.array([2**-10, 3 * 2**-11, 448, -448, 464, -464, 1e36, -3e38, 3.4e38], dtype=numpy.float32)
+        x = numpy.concatenate([x, extra, [numpy.inf, -numpy.inf, numpy.nan, -numpy.nan]]).astype(numpy.float32)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            actual = float32_to_float8e4m3_array(x).view(numpy.uint8)
+        with numpy.errstate(all="ignore"):
+            expected = numpy.array([helper.float32_to_float8e4m3(v) for v in x], dtype=numpy.uint8)
+
+        mismatches = numpy.nonzero(actual != expected)[0]
+        self.assertEqual(
+            len(mismatches),
+            0,
+            msg=f"{[(x[i], actual[i], expected[i]) for i in mismatches[:10]]}",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,48 +9,69 @@
 # Licensed under the MIT License.  See License.txt in the project root for
 # license information.
 # -------------------------------------------------------------------------
+import functools
+import importlib.util
+import itertools
+import logging
 import math
 import os
 import platform
 import random
 import unittest
+from dataclasses import dataclass
+from typing import NamedTuple
 
 import numpy
 import torch
-from einops import rearrange, repeat
-from onnx import TensorProto, helper
+from onnx import ModelProto, TensorProto, helper
 from packaging import version
 from parameterized import parameterized
 from test_gqa_cpu import smooth_softmax_ref
 
-from onnxruntime import InferenceSession, OrtValue, SessionOptions, get_available_providers
+from onnxruntime import InferenceSession, SessionOptions, get_available_providers
+
+try:
+    import flash_attn
+    from flash_attn import flash_attn_with_kvcache
+except ImportError:
+    flash_attn_with_kvcache = None
+else:
+    # The softcap argument of flash_attn_with_kvcache was added in flash-attn 2.6.
+    if version.parse(flash_attn.__version__) < version.parse("2.6"):
+        flash_attn_with_kvcache = None
+
+logger = logging.getLogger(__name__)
 
 torch.manual_seed(0)
 
 pipeline_mode = True  # Reduces number of tests so pipeline doesn't time out
 
+# Head sizes tested outside of the pipeline. The kernels only branch on head sizes that are not a multiple of 16 and on
+# the size buckets, so one head size per bucket is tested unless ONNXRUNTIME_GQA_FULL_SWEEP=1 is set.
+if os.environ.get("ONNXRUNTIME_GQA_FULL_SWEEP", "0") == "1":
+    sweep_head_sizes = [32, 40, 64, 80, 96, 128, 160, 192, 224, 256]
+else:
+    sweep_head_sizes = [40, 64, 128, 256]
+
+# The helpers below that are memoized with functools.lru_cache and return device tensors (randn_fp16,
+# _local_mask_static, rotary_cos_sin_cache, arange_row, full_seqlens and full_padding_mask) share their results between
+# the tests, so callers must not modify the returned tensors.
+
 
 class Formats:
     BSNH = 0
     BNSH = 1
 
 
+@dataclass(frozen=True, slots=True)
 class Config:
-    batch_size = 0
-    sequence_length = 0
-    kv_sequence_length = 0  # this is past sequence length when there is past state.
-    num_heads = 0
-    kv_num_heads = 0
-    head_size = 0
-    ep = "CUDAExecutionProvider"
-
-    def __init__(self, batch_size, sequence_length, kv_sequence_length, num_heads, kv_num_heads, head_size):
-        self.batch_size = batch_size
-        self.sequence_length = sequence_length
-        self.kv_sequence_length = kv_sequence_length
-        self.num_heads = num_heads
-        self.kv_num_heads = kv_num_heads
-        self.head_size = head_size
+    batch_size: int
+    sequence_length: int
+    kv_sequence_length: int  # this is past sequence length when there is past state.
+    num_heads: int
+    kv_num_heads: int
+    head_size: int
+    ep: str = "CUDAExecutionProvider"
 
     def __repr__(self):
         short_ep = self.ep[: -len("ExecutionProvider")].lower()
@@ -61,33 +82,16 @@ class Config:
         )
 
 
+@dataclass(frozen=True, slots=True)
 class PromptConfig:
-    batch_size = 0
-    q_sequence_length = 0
-    kv_sequence_length = 0
-    buffer_sequence_length = 0
-    num_heads = 0
-    kv_num_heads = 0
-    head_size = 0
-    ep = "CUDAExecutionProvider"
-
-    def __init__(
-        self,
-        batch_size,
-        q_sequence_length,
-        kv_sequence_length,
-        buffer_sequence_length,
-        num_heads,
-        kv_num_heads,
-        head_size,
-    ):
-        self.batch_size = batch_size
-        self.q_sequence_length = q_sequence_length
-        self.kv_sequence_length = kv_sequence_length
-        self.buffer_sequence_length = buffer_sequence_length
-        self.num_heads = num_heads
-        self.kv_num_heads = kv_num_heads
-        self.head_size = head_size
+    batch_size: int
+    q_sequence_length: int
+    kv_sequence_length: int
+    buffer_sequence_length: int
+    num_heads: int
+    kv_num_heads: int
+    head_size: int
+    ep: str = "CUDAExecutionProvider"
 
     def __repr__(self):
         short_ep = self.ep[: -len("ExecutionProvider")].lower()
@@ -98,20 +102,38 @@ class PromptConfig:
         )
 
 
-def create_group_query_attention_graph_prompt(
-    config,
-    past_kv_format=Formats.BSNH,
-    share_buffer=True,
-    local_window_size=-1,
-    rotary=False,
-    rotary_interleaved=False,
-    packed=False,
-    interactive=False,
-    softcap=0.0,
-    use_smooth_softmax=False,
+def kv_cache_shape(past_kv_format, sequence_length, kv_num_heads, head_size, batch_size="batch_size"):
+    """Shape of the past or present key and value in the given format."""
+    if past_kv_format == Formats.BSNH:
+        return [batch_size, sequence_length, kv_num_heads, head_size]
+    return [batch_size, kv_num_heads, sequence_length, head_size]
+
+
+def set_node_attributes(node, **attributes):
+    """Overwrites the values of existing attributes of a node, the attribute types are inferred from the values."""
+    for attribute in node.attribute:
+        if attribute.name in attributes:
+            attribute.CopyFrom(helper.make_attribute(attribute.name, attributes[attribute.name]))
+
+
+@functools.lru_cache(maxsize=None)
+def _create_group_query_attention_prompt_template(
+    num_heads,
+    kv_num_heads,
+    head_size,
+    past_kv_format,
+    share_buffer,
+    rotary,
+    packed,
 ):
-    past_kv_seqlen = config.buffer_sequence_length if share_buffer else 0
-    present_kv_seqlen = config.buffer_sequence_length if share_buffer else config.kv_sequence_length
+    # Only the head dimensions are fixed, graphs that differ by their batch size or sequence lengths serialize to the
+    # same model and share the cached session. The attributes which do not change the graph structure are patched in
+    # copies of this template.
+    q_hidden_size = num_heads * head_size
+    kv_hidden_size = kv_num_heads * head_size
+    rotary_cache_dim = (math.floor(head_size / 16) * 16) // 2
+    past_kv_shape = kv_cache_shape(past_kv_format, "past_sequence_length", kv_num_heads, head_size)
+    present_kv_shape = kv_cache_shape(past_kv_format, "present_sequence_length", kv_num_heads, head_size)
     nodes = [
         helper.make_node(
             "GroupQueryAttention",
@@ -128,13 +150,13 @@ def create_group_query_attention_graph_prompt(
             ],
             ["output", "present_key", "present_value"],
             "GroupQueryAttention_0",
-            num_heads=config.num_heads,
-            kv_num_heads=config.kv_num_heads,
-            local_window_size=local_window_size,
+            num_heads=num_heads,
+            kv_num_heads=kv_num_heads,
+            local_window_size=-1,
             do_rotary=rotary,
-            rotary_interleaved=rotary_interleaved,
-            softcap=softcap,
-            smooth_softmax=1 if use_smooth_softmax else 0,
+            rotary_interleaved=0,
+            softcap=0.0,
+            smooth_softmax=0,
             # is_past_bsnh=1 if past_kv_format == Formats.BSNH else 0,
             # kv_share_buffer=1 if share_buffer else 0,
             domain="com.microsoft",
@@ -146,19 +168,15 @@ def create_group_query_attention_graph_prompt(
             "query",
             TensorProto.FLOAT16,
             [
-                config.batch_size,
-                config.q_sequence_length,
-                (
-                    (config.num_heads * config.head_size)
-                    if not packed
-                    else (config.num_heads * config.head_size + 2 * config.kv_num_heads * config.head_size)
-                ),
+                "batch_size",
+                "sequence_length",
+                q_hidden_size if not packed else q_hidden_size + 2 * kv_hidden_size,
             ],
         ),
         helper.make_tensor_value_info(
             "seqlens_k",
             TensorProto.INT32,
-            [config.batch_size],
+            ["batch_size"],
         ),
         helper.make_tensor_value_info(
             "total_sequence_length",
@@ -172,18 +190,18 @@ def create_group_query_attention_graph_prompt(
                 "key",
                 TensorProto.FLOAT16,
                 [
-                    config.batch_size,
-                    config.kv_sequence_length,
-                    config.kv_num_heads * config.head_size,
+                    "batch_size",
+                    "kv_sequence_length",
+                    kv_hidden_size,
                 ],
             ),
             helper.make_tensor_value_info(
                 "value",
                 TensorProto.FLOAT16,
                 [
-                    config.batch_size,
-                    config.kv_sequence_length,
-                    config.kv_num_heads * config.head_size,
+                    "batch_size",
+                    "kv_sequence_length",
+                    kv_hidden_size,
                 ],
             ),
         ]
@@ -192,22 +210,12 @@ def create_group_query_attention_graph_prompt(
             helper.make_tensor_value_info(
                 "past_key",
                 TensorProto.FLOAT16,
-                [
-                    config.batch_size,
-                    past_kv_seqlen if past_kv_format == Formats.BSNH else config.kv_num_heads,
-                    config.kv_num_heads if past_kv_format == Formats.BSNH else past_kv_seqlen,
-                    config.head_size,
-                ],
+                past_kv_shape,
             ),
             helper.make_tensor_value_info(
                 "past_value",
                 TensorProto.FLOAT16,
-                [
-                    config.batch_size,
-                    past_kv_seqlen if past_kv_format == Formats.BSNH else config.kv_num_heads,
-                    config.kv_num_heads if past_kv_format == Formats.BSNH else past_kv_seqlen,
-                    config.head_size,
-                ],
+                past_kv_shape,
             ),
         ]
     if rotary:
@@ -216,16 +224,16 @@ def create_group_query_attention_graph_prompt(
                 "cos_cache",
                 TensorProto.FLOAT16,
                 [
-                    config.buffer_sequence_length if share_buffer else config.kv_sequence_length,
-                    (math.floor(config.head_size / 16) * 16) // 2,
+                    "max_sequence_length",
+                    rotary_cache_dim,
                 ],
             ),
             helper.make_tensor_value_info(
                 "sin_cache",
                 TensorProto.FLOAT16,
                 [
-                    config.buffer_sequence_length if share_buffer else config.kv_sequence_length,
-                    (math.floor(config.head_size / 16) * 16) // 2,
+                    "max_sequence_length",
+                    rotary_cache_dim,
                 ],
             ),
         ]
@@ -234,47 +242,17 @@ def create_group_query_attention_graph_prompt(
         helper.make_tensor_value_info(
             "output",
             TensorProto.FLOAT16,
-            [config.batch_size, config.q_sequence_length, config.num_heads * config.head_size],
-        ),
-        helper.make_tensor_value_info(
-            "present_key",
-            TensorProto.FLOAT16,
-            [
-                config.batch_size,
-                present_kv_seqlen if past_kv_format == Formats.BSNH else config.kv_num_heads,
-                config.kv_num_heads if past_kv_format == Formats.BSNH else present_kv_seqlen,
-                config.head_size,
-            ],
-        ),
-        helper.make_tensor_value_info(
-            "present_value",
-            TensorProto.FLOAT16,
-            [
-                config.batch_size,
-                present_kv_seqlen if past_kv_format == Formats.BSNH else config.kv_num_heads,
-                config.kv_num_heads if past_kv_format == Formats.BSNH else present_kv_seqlen,
-                config.head_size,
-            ],
+            ["batch_size", "sequence_length", q_hidden_size],
         ),
         helper.make_tensor_value_info(
             "present_key",
             TensorProto.FLOAT16,
-            [
-                config.batch_size,
-                config.kv_sequence_length if past_kv_format == Formats.BSNH else config.kv_num_heads,
-                config.kv_num_heads if past_kv_format == Formats.BSNH else config.kv_sequence_length,
-                config.head_size,
-            ],
+            present_kv_shape,
         ),
         helper.make_tensor_value_info(
             "present_value",
             TensorProto.FLOAT16,
-            [
-                config.batch_size,
-                config.kv_sequence_length if past_kv_format == Formats.BSNH else config.kv_num_heads,
-                config.kv_num_heads if past_kv_format == Formats.BSNH else config.kv_sequence_length,
-                config.head_size,
-            ],
+            present_kv_shape,
         ),
     ]
 
@@ -285,11 +263,10 @@ def create_group_query_attention_graph_prompt(
         graph_output,
     )
 
-    model = helper.make_model(graph)
-    return model.SerializeToString()
+    return helper.make_model(graph)
 
 
-def create_group_query_attention_graph_past(
+def create_group_query_attention_graph_prompt(
     config,
     past_kv_format=Formats.BSNH,
     share_buffer=True,
@@ -297,13 +274,48 @@ def create_group_query_attention_graph_past(
     rotary=False,
     rotary_interleaved=False,
     packed=False,
+    interactive=False,
     softcap=0.0,
     use_smooth_softmax=False,
 ):
-    past_kv_seqlen = config.kv_sequence_length
-    present_kv_seqlen = (
-        config.kv_sequence_length if share_buffer else config.kv_sequence_length + config.sequence_length
+    model = ModelProto()
+    model.CopyFrom(
+        _create_group_query_attention_prompt_template(
+            config.num_heads,
+            config.kv_num_heads,
+            config.head_size,
+            past_kv_format,
+            share_buffer,
+            rotary,
+            packed,
+        )
+    )
+    set_node_attributes(
+        model.graph.node[0],
+        local_window_size=local_window_size,
+        rotary_interleaved=1 if rotary_interleaved else 0,
+        softcap=float(softcap),
+        smooth_softmax=1 if use_smooth_softmax else 0,
     )
+    return model.SerializeToString()
+
+
+@functools.lru_cache(maxsize=None)
+def _create_group_query_attention_past_template(
+    num_heads,
+    kv_num_heads,
+    head_size,
+    past_kv_format,
+    share_buffer,
+    rotary,
+    packed,
+):
+    # Only the head dimensions are fixed, as in _create_group_query_attention_prompt_template.
+    q_hidden_size = num_heads * head_size
+    kv_hidden_size = kv_num_heads * head_size
+    rotary_cache_dim = (math.floor(head_size / 16) * 16) // 2
+    past_kv_shape = kv_cache_shape(past_kv_format, "past_sequence_length", kv_num_heads, head_size)
+    present_kv_shape = kv_cache_shape(past_kv_format, "present_sequence_length", kv_num_heads, head_size)
     nodes = [
         helper.make_node(
             "GroupQueryAttention",
@@ -320,13 +332,13 @@ def create_group_query_attention_graph_past(
             ],
             ["output", "present_key", "present_value"],
             "GroupQueryAttention_0",
-            num_heads=config.num_heads,
-            kv_num_heads=config.kv_num_heads,
-            local_window_size=local_window_size,
+            num_heads=num_heads,
+            kv_num_heads=kv_num_heads,
+            local_window_size=-1,
             do_rotary=rotary,
-            rotary_interleaved=rotary_interleaved,
-            softcap=softcap,
-            smooth_softmax=1 if use_smooth_softmax else 0,
+            rotary_interleaved=0,
+            softcap=0.0,
+            smooth_softmax=0,
             # is_past_bsnh=1 if past_kv_format == Formats.BSNH else 0,
             # kv_share_buffer=1 if share_buffer else 0,
             domain="com.microsoft",
@@ -338,39 +350,25 @@ def create_group_query_attention_graph_past(
             "query",
             TensorProto.FLOAT16,
             [
-                config.batch_size,
-                config.sequence_length,
-                (
-                    (config.num_heads * config.head_size)
-                    if not packed
-                    else (config.num_heads * config.head_size + 2 * config.kv_num_heads * config.head_size)
-                ),
+                "batch_size",
+                "sequence_length",
+                q_hidden_size if not packed else q_hidden_size + 2 * kv_hidden_size,
             ],
         ),
         helper.make_tensor_value_info(
             "past_key",
             TensorProto.FLOAT16,
-            [
-                config.batch_size,
-                past_kv_seqlen if past_kv_format == Formats.BSNH else config.kv_num_heads,
-                config.kv_num_heads if past_kv_format == Formats.BSNH else past_kv_seqlen,
-                config.head_size,
-            ],
+            past_kv_shape,
         ),
         helper.make_tensor_value_info(
             "past_value",
             TensorProto.FLOAT16,
-            [
-                config.batch_size,
-                past_kv_seqlen if past_kv_format == Formats.BSNH else config.kv_num_heads,
-                config.kv_num_heads if past_kv_format == Formats.BSNH else past_kv_seqlen,
-                config.head_size,
-            ],
+            past_kv_shape,
         ),
         helper.make_tensor_value_info(
             "seqlens_k",
             TensorProto.INT32,
-            [config.batch_size],
+            ["batch_size"],
         ),
         helper.make_tensor_value_info(
             "total_sequence_length",
@@ -384,18 +382,18 @@ def create_group_query_attention_graph_past(
                 "key",
                 TensorProto.FLOAT16,
                 [
-                    config.batch_size,
-                    config.sequence_length,
-                    config.kv_num_heads * config.head_size,
+                    "batch_size",
+                    "sequence_length",
+                    kv_hidden_size,
                 ],
             ),
             helper.make_tensor_value_info(
                 "value",
                 TensorProto.FLOAT16,
                 [
-                    config.batch_size,
-                    config.sequence_length,
-                    config.kv_num_heads * config.head_size,
+                    "batch_size",
+                    "sequence_length",
+                    kv_hidden_size,
                 ],
             ),
         ]
@@ -405,16 +403,16 @@ def create_group_query_attention_graph_past(
                 "cos_cache",
                 TensorProto.FLOAT16,
                 [
-                    config.kv_sequence_length + (0 if share_buffer else config.sequence_length),
-                    (math.floor(config.head_size / 16) * 16) // 2,
+                    "max_sequence_length",
+                    rotary_cache_dim,
                 ],
             ),
             helper.make_tensor_value_info(
                 "sin_cache",
                 TensorProto.FLOAT16,
                 [
-                    config.kv_sequence_length + (0 if share_buffer else config.sequence_length),
-                    (math.floor(config.head_size / 16) * 16) // 2,
+                    "max_sequence_length",
+                    rotary_cache_dim,
                 ],
             ),
         ]
@@ -423,27 +421,17 @@ def create_group_query_attention_graph_past(
         helper.make_tensor_value_info(
             "output",
             TensorProto.FLOAT16,
-            [config.batch_size, config.sequence_length, config.num_heads * config.head_size],
+            ["batch_size", "sequence_length", q_hidden_size],
         ),
         helper.make_tensor_value_info(
             "present_key",
             TensorProto.FLOAT16,
-            [
-                config.batch_size,
-                present_kv_seqlen if past_kv_format == Formats.BSNH else config.kv_num_heads,
-                config.kv_num_heads if past_kv_format == Formats.BSNH else present_kv_seqlen,
-                config.head_size,
-            ],
+            present_kv_shape,
         ),
         helper.make_tensor_value_info(
             "present_value",
             TensorProto.FLOAT16,
-            [
-                config.batch_size,
-                present_kv_seqlen if past_kv_format == Formats.BSNH else config.kv_num_heads,
-                config.kv_num_heads if past_kv_format == Formats.BSNH else present_kv_seqlen,
-                config.head_size,
-            ],
+            present_kv_shape,
         ),
     ]
 
@@ -454,14 +442,172 @@ def create_group_query_attention_graph_past(
         graph_output,
     )
 
-    model = helper.make_model(graph)
+    return helper.make_model(graph)
+
+
+def create_group_query_attention_graph_past(
+    config,
+    past_kv_format=Formats.BSNH,
+    share_buffer=True,
+    local_window_size=-1,
+    rotary=False,
+    rotary_interleaved=False,
+    packed=False,
+    softcap=0.0,
+    use_smooth_softmax=False,
+):
+    model = ModelProto()
+    model.CopyFrom(
+        _create_group_query_attention_past_template(
+            config.num_heads,
+            config.kv_num_heads,
+            config.head_size,
+            past_kv_format,
+            share_buffer,
+            rotary,
+            packed,
+        )
+    )
+    set_node_attributes(
+        model.graph.node[0],
+        local_window_size=local_window_size,
+        rotary_interleaved=1 if rotary_interleaved else 0,
+        softcap=float(softcap),
+        smooth_softmax=1 if use_smooth_softmax else 0,
+    )
     return model.SerializeToString()
 
 
-def rotary_options_for_current_os():
-    # Reference implementation of rotary uses triton, which is not available in Windows.
-    # So we only test rotary in Linux right now.
-    return [(False, False)] if platform.system() != "Linux" else [(True, False), (True, True), (False, False)]
+# (rotary, rotary_interleaved) options of the test cases. The reference implementation of rotary is written in torch,
+# so rotary is tested on all the platforms.
+ROTARY_OPTIONS = ((True, False), (True, True), (False, False))
+
+
+@functools.lru_cache(maxsize=32)
+def _create_gqa_session(onnx_model_str, ep, disable_flash_attention):
+    session = InferenceSession(onnx_model_str, SessionOptions(), providers=[ep])
+    return session, session.io_binding()
+
+
+def get_gqa_session(onnx_model_str, ep):
+    """
+    Returns a session for the serialized model and its IOBinding, both are reused by tests building the same graph.
+    The attention kernel is chosen when the session is created so ORT_DISABLE_FLASH_ATTENTION is part of the key.
+    Each session keeps its own device memory arena, the cache is kept small.
+    """
+    return _create_gqa_session(onnx_model_str, ep, os.environ.get("ORT_DISABLE_FLASH_ATTENTION"))
+
+
+TORCH_TO_NUMPY_TYPE = {torch.float16: numpy.float16, torch.int32: numpy.int32}
+
+
+def bind_cuda_tensor(io_binding, name, tensor, is_output=False):
+    """
+    Binds a torch tensor already on the device without copying it to host memory first.
+    Returns the bound tensor, the caller must keep it alive until the session has run.
+    """
+    tensor = tensor.contiguous()
+    bind = io_binding.bind_output if is_output else io_binding.bind_input
+    bind(name, "cuda", 0, TORCH_TO_NUMPY_TYPE[tensor.dtype], tuple(tensor.shape), tensor.data_ptr())
+    return tensor
+
+
+@functools.cache
+def _pinned_total_sequence_length():
+    # Page-locked host buffer reused by all the runs, created lazily since it needs CUDA.
+    return torch.empty(1, dtype=torch.int32, pin_memory=True)
+
+
+def run_gqa_session(
+    onnx_model_str,
+    config,
+    q,
+    new_k,
+    new_v,
+    cos,
+    sin,
+    seqlens_k,
+    total_sequence_length,
+    past_k=None,
+    past_v=None,
+    share_buffer=True,
+    present_shape=None,
+):
+    """
+    Runs the GQA session on device tensors and returns output, present_key and present_value on the device.
+    present_shape is the shape of present_key and present_value when they do not share the past buffers.
+    """
+    ort_session, io_binding = get_gqa_session(onnx_model_str, config.ep)
+    # The binding is reused by all the runs of the session, the tensors bound by the previous run are released first.
+    io_binding.clear_binding_inputs()
+    io_binding.clear_binding_outputs()
+    bound = [
+        bind_cuda_tensor(io_binding, "query", q),
+        bind_cuda_tensor(io_binding, "seqlens_k", seqlens_k.to(torch.int32)),
+    ]
+    if new_k is not None:
+        bound.append(bind_cuda_tensor(io_binding, "key", new_k))
+        bound.append(bind_cuda_tensor(io_binding, "value", new_v))
+    if cos is not None:
+        bound.append(bind_cuda_tensor(io_binding, "cos_cache", cos))
+        bound.append(bind_cuda_tensor(io_binding, "sin_cache", sin))
+    if past_k is not None:
+        past_k = bind_cuda_tensor(io_binding, "past_key", past_k)
+        past_v = bind_cuda_tensor(io_binding, "past_value", past_v)
+    # total_sequence_length is expected in host memory by the operator.
+    total = _pinned_total_sequence_length()
+    total.fill_(total_sequence_length)
+    io_binding.bind_cpu_input("total_sequence_length", total.numpy())
+    output = torch.empty(
+        q.shape[0], q.shape[1], config.num_heads * config.head_size, dtype=torch.float16, device="cuda"
+    )
+    bind_cuda_tensor(io_binding, "output", output, is_output=True)
+    if share_buffer:
+        # present_key and present_value are updated in place in the past buffers.
+        present_k, present_v = past_k, past_v
+    else:
+        present_k = torch.empty(present_shape, dtype=torch.float16, device="cuda")
+        present_v = torch.empty(present_shape, dtype=torch.float16, device="cuda")
+    bind_cuda_tensor(io_binding, "present_key", present_k, is_output=True)
+    bind_cuda_tensor(io_binding, "present_value", present_v, is_output=True)
+    # The inputs are produced by torch on its own stream.
+    torch.cuda.synchronize()
+    ort_session.run_with_iobinding(io_binding)
+    return output, present_k, present_v
+
+
+def sample_fp16(*shape, seed=0):
+    """Samples a float16 tensor from the standard normal distribution directly on the device."""
+    generator = torch.Generator(device="cuda")
+    generator.manual_seed(seed)
+    return torch.empty(shape, dtype=torch.float16, device="cuda").normal_(generator=generator)
+
+
+@functools.lru_cache(maxsize=8)
+def randn_fp16(*shape, seed=0):
+    """
+    sample_fp16 cached for the q, k and v inputs of the new tokens, shared by the tests using the same shape and seed.
+    The past caches are much larger and are sampled with sample_fp16 instead, so that they are not kept alive.
+    """
+    return sample_fp16(*shape, seed=seed)
+
+
+def randn_qkv(batch_size, sequence_length, kv_sequence_length, num_heads, kv_num_heads, head_size, packed=False):
+    """
+    Samples q (batch_size, sequence_length, num_heads, head_size), new_k and new_v
+    (batch_size, kv_sequence_length, kv_num_heads, head_size). When packed, they are views of a single
+    (batch_size, sequence_length, num_heads + 2 * kv_num_heads, head_size) tensor, which is also returned as the
+    packed input so it does not need to be concatenated. Otherwise the packed input is None.
+    """
+    if packed:
+        assert sequence_length == kv_sequence_length
+        packed_qkv = randn_fp16(batch_size, sequence_length, num_heads + 2 * kv_num_heads, head_size, seed=5)
+        q, new_k, new_v = packed_qkv.split([num_heads, kv_num_heads, kv_num_heads], dim=2)
+        return q, new_k, new_v, packed_qkv
+    q = randn_fp16(batch_size, sequence_length, num_heads, head_size, seed=0)
+    new_k = randn_fp16(batch_size, kv_sequence_length, kv_num_heads, head_size, seed=3)
+    new_v = randn_fp16(batch_size, kv_sequence_length, kv_num_heads, head_size, seed=4)
+    return q, new_k, new_v, None
 
 
 def gqa_prompt_func(
@@ -498,79 +644,23 @@ def gqa_prompt_func(
     if new_k is not None:
         new_k = torch.reshape(new_k, (config.batch_size, config.kv_sequence_length, -1))
         new_v = torch.reshape(new_v, (config.batch_size, config.kv_sequence_length, -1))
-    if share_buffer:
-        ort_inputs = {
-            "query": q.detach().cpu().numpy(),
-            "past_key": OrtValue.ortvalue_from_numpy(past_k.detach().cpu().numpy(), "cuda", 0),
-            "past_value": OrtValue.ortvalue_from_numpy(past_v.detach().cpu().numpy(), "cuda", 0),
-            "seqlens_k": seqlens_k.detach().cpu().numpy().astype(numpy.int32),
-            "total_sequence_length": torch.tensor([config.q_sequence_length], dtype=torch.int32).detach().cpu().numpy(),
-        }
-        sess_options = SessionOptions()
-        ort_session = InferenceSession(onnx_model_str, sess_options, providers=[config.ep])
-        io_binding = ort_session.io_binding()
-        if new_k is not None:
-            ort_inputs["key"] = new_k.detach().cpu().numpy()
-            ort_inputs["value"] = new_v.detach().cpu().numpy()
-            io_binding.bind_cpu_input("key", ort_inputs["key"])
-            io_binding.bind_cpu_input("value", ort_inputs["value"])
-        if cos is not None:
-            ort_inputs["cos_cache"] = cos.detach().cpu().numpy()
-            ort_inputs["sin_cache"] = sin.detach().cpu().numpy()
-            io_binding.bind_cpu_input("cos_cache", ort_inputs["cos_cache"])
-            io_binding.bind_cpu_input("sin_cache", ort_inputs["sin_cache"])
-        io_binding.bind_cpu_input("query", ort_inputs["query"])
-        io_binding.bind_input(
-            "past_key", "cuda", 0, numpy.float16, ort_inputs["past_key"].shape(), ort_inputs["past_key"].data_ptr()
-        )
-        io_binding.bind_input(
-            "past_value",
-            "cuda",
-            0,
-            numpy.float16,
-            ort_inputs["past_value"].shape(),
-            ort_inputs["past_value"].data_ptr(),
-        )
-        io_binding.bind_cpu_input("seqlens_k", ort_inputs["seqlens_k"])
-        io_binding.bind_cpu_input("total_sequence_length", ort_inputs["total_sequence_length"])
-        io_binding.bind_output("output")
-        io_binding.bind_ortvalue_output("present_key", ort_inputs["past_key"])
-        io_binding.bind_ortvalue_output("present_value", ort_inputs["past_value"])
-        ort_session.run_with_iobinding(io_binding)
-        ort_output, present_k, present_v = io_binding.copy_outputs_to_cpu()
-        ort_output = numpy.array(ort_output)
-        output = torch.tensor(ort_output)
-        return output, present_k, present_v
-    else:
-        ort_inputs = {
-            "query": q.detach().cpu().numpy(),
-            "seqlens_k": seqlens_k.detach().cpu().numpy().astype(numpy.int32),
-            "total_sequence_length": torch.tensor([config.q_sequence_length], dtype=torch.int32).detach().cpu().numpy(),
-        }
-        sess_options = SessionOptions()
-        ort_session = InferenceSession(onnx_model_str, sess_options, providers=[config.ep])
-        io_binding = ort_session.io_binding()
-        if new_k is not None:
-            ort_inputs["key"] = new_k.detach().cpu().numpy()
-            ort_inputs["value"] = new_v.detach().cpu().numpy()
-            io_binding.bind_cpu_input("key", ort_inputs["key"])
-            io_binding.bind_cpu_input("value", ort_inputs["value"])
-        if cos is not None:
-            ort_inputs["cos_cache"] = cos.detach().cpu().numpy()
-            ort_inputs["sin_cache"] = sin.detach().cpu().numpy()
-            io_binding.bind_cpu_input("cos_cache", ort_inputs["cos_cache"])
-            io_binding.bind_cpu_input("sin_cache", ort_inputs["sin_cache"])
-        io_binding.bind_cpu_input("query", ort_inputs["query"])
-        io_binding.bind_cpu_input("seqlens_k", ort_inputs["seqlens_k"])
-        io_binding.bind_cpu_input("total_sequence_length", ort_inputs["total_sequence_length"])
-        io_binding.bind_output("output")
-        io_binding.bind_output("present_key")
-        io_binding.bind_output("present_value")
-        ort_session.run_with_iobinding(io_binding)
-        ort_output, present_k, present_v = io_binding.copy_outputs_to_cpu()
-        ort_output = numpy.array(ort_output)
-        output = torch.tensor(ort_output)
-        return output, present_k, present_v
+    return run_gqa_session(
+        onnx_model_str,
+        config,
+        q,
+        new_k,
+        new_v,
+        cos,
+        sin,
+        seqlens_k,
+        config.q_sequence_length,
+        past_k,
+        past_v,
+        share_buffer,
+        kv_cache_shape(
+            past_kv_format, config.kv_sequence_length, config.kv_num_heads, config.head_size, config.batch_size
+        ),
+    )
 
 
 def gqa_past_func(
@@ -607,91 +697,36 @@ def gqa_past_func(
     if new_k is not None:
         new_k = torch.reshape(new_k, (config.batch_size, config.sequence_length, -1))
         new_v = torch.reshape(new_v, (config.batch_size, config.sequence_length, -1))
-    if share_buffer:
-        ort_inputs = {
-            "query": q.detach().cpu().numpy(),
-            "past_key": OrtValue.ortvalue_from_numpy(past_k.detach().cpu().numpy(), "cuda", 0),
-            "past_value": OrtValue.ortvalue_from_numpy(past_v.detach().cpu().numpy(), "cuda", 0),
-            "seqlens_k": seqlens_k.detach().cpu().numpy().astype(numpy.int32),
-            "total_sequence_length": torch.tensor([config.kv_sequence_length], dtype=torch.int32)
-            .detach()
-            .cpu()
-            .numpy(),
-        }
-        sess_options = SessionOptions()
-        ort_session = InferenceSession(onnx_model_str, sess_options, providers=[config.ep])
-        io_binding = ort_session.io_binding()
-        if new_k is not None:
-            ort_inputs["key"] = new_k.detach().cpu().numpy()
-            ort_inputs["value"] = new_v.detach().cpu().numpy()
-            io_binding.bind_cpu_input("key", ort_inputs["key"])
-            io_binding.bind_cpu_input("value", ort_inputs["value"])
-        if cos is not None:
-            ort_inputs["cos_cache"] = cos.detach().cpu().numpy()
-            ort_inputs["sin_cache"] = sin.detach().cpu().numpy()
-            io_binding.bind_cpu_input("cos_cache", ort_inputs["cos_cache"])
-            io_binding.bind_cpu_input("sin_cache", ort_inputs["sin_cache"])
-        io_binding.bind_cpu_input("query", ort_inputs["query"])
-        io_binding.bind_input(
-            "past_key", "cuda", 0, numpy.float16, ort_inputs["past_key"].shape(), ort_inputs["past_key"].data_ptr()
-        )
-        io_binding.bind_input(
-            "past_value",
-            "cuda",
-            0,
-            numpy.float16,
-            ort_inputs["past_value"].shape(),
-            ort_inputs["past_value"].data_ptr(),
-        )
-        io_binding.bind_cpu_input("seqlens_k", ort_inputs["seqlens_k"])
-        io_binding.bind_cpu_input("total_sequence_length", ort_inputs["total_sequence_length"])
-        io_binding.bind_output("output")
-        io_binding.bind_ortvalue_output("present_key", ort_inputs["past_key"])
-        io_binding.bind_ortvalue_output("present_value", ort_inputs["past_value"])
-        ort_session.run_with_iobinding(io_binding)
-        ort_output, present_k, present_v = io_binding.copy_outputs_to_cpu()
-        ort_output = numpy.array(ort_output)
-        output = torch.tensor(ort_output)
-        return output, present_k, present_v
-    else:
-        ort_inputs = {
-            "query": q.detach().cpu().numpy(),
-            "past_key": past_k.detach().cpu().numpy(),
-            "past_value": past_v.detach().cpu().numpy(),
-            "seqlens_k": seqlens_k.detach().cpu().numpy().astype(numpy.int32),
-            "total_sequence_length": torch.tensor(
-                [config.kv_sequence_length + config.sequence_length], dtype=torch.int32
-            )
-            .detach()
-            .cpu()
-            .numpy(),
-        }
-        sess_options = SessionOptions()
-        ort_session = InferenceSession(onnx_model_str, sess_options, providers=[config.ep])
-        io_binding = ort_session.io_binding()
-        if new_k is not None:
-            ort_inputs["key"] = new_k.detach().cpu().numpy()
-            ort_inputs["value"] = new_v.detach().cpu().numpy()
-            io_binding.bind_cpu_input("key", ort_inputs["key"])
-            io_binding.bind_cpu_input("value", ort_inputs["value"])
-        if cos is not None:
-            ort_inputs["cos_cache"] = cos.detach().cpu().numpy()
-            ort_inputs["sin_cache"] = sin.detach().cpu().numpy()
-            io_binding.bind_cpu_input("cos_cache", ort_inputs["cos_cache"])
-            io_binding.bind_cpu_input("sin_cache", ort_inputs["sin_cache"])
-        io_binding.bind_cpu_input("query", ort_inputs["query"])
-        io_binding.bind_cpu_input("past_key", ort_inputs["past_key"])
-        io_binding.bind_cpu_input("past_value", ort_inputs["past_value"])
-        io_binding.bind_cpu_input("seqlens_k", ort_inputs["seqlens_k"])
-        io_binding.bind_cpu_input("total_sequence_length", ort_inputs["total_sequence_length"])
-        io_binding.bind_output("output")
-        io_binding.bind_output("present_key")
-        io_binding.bind_output("present_value")
-        ort_session.run_with_iobinding(io_binding)
-        ort_output, present_k, present_v = io_binding.copy_outputs_to_cpu()
-        ort_output = numpy.array(ort_output)
-        output = torch.tensor(ort_output)
-        return output, present_k, present_v
+    total_sequence_length = config.kv_sequence_length + (0 if share_buffer else config.sequence_length)
+    present_shape = kv_cache_shape(
+        past_kv_format, total_sequence_length, config.kv_num_heads, config.head_size, config.batch_size
+    )
+    return run_gqa_session(
+        onnx_model_str,
+        config,
+        q,
+        new_k,
+        new_v,
+        cos,
+        sin,
+        seqlens_k,
+        total_sequence_length,
+        past_k,
+        past_v,
+        share_buffer,
+        present_shape,
+    )
+
+
+@functools.lru_cache(maxsize=128)
+def _local_mask_static(seqlen_q, seqlen_k, window_left, window_right, device):
+    # Local mask without padding, it is the same for all the batches.
+    row_idx = torch.arange(seqlen_q, device=device, dtype=torch.long)[:, None]
+    col_idx = torch.arange(seqlen_k, device=device, dtype=torch.long)[None, :]
+    offset = seqlen_k - seqlen_q
+    if window_left < 0:
+        return col_idx > row_idx + offset + window_right
+    return (col_idx > row_idx + offset + window_right) | (col_idx < row_idx + offset - window_left)
 
 
 def construct_local_mask(
@@ -702,10 +737,14 @@ def construct_local_mask(
     key_padding_mask=None,
     device=None,
 ):
-    row_idx = rearrange(torch.arange(seqlen_q, device=device, dtype=torch.long), "s -> s 1")
+    if query_padding_mask is None and key_padding_mask is None:
+        return _local_mask_static(
+            seqlen_q, seqlen_k, window_size[0], window_size[1], None if device is None else str(device)
+        )
+    row_idx = torch.arange(seqlen_q, device=device, dtype=torch.long).unsqueeze(1)
     col_idx = torch.arange(seqlen_k, device=device, dtype=torch.long)
-    sk = seqlen_k if key_padding_mask is None else rearrange(key_padding_mask.sum(-1), "b -> b 1 1 1")
-    sq = seqlen_q if query_padding_mask is None else rearrange(query_padding_mask.sum(-1), "b -> b 1 1 1")
+    sk = seqlen_k if key_padding_mask is None else key_padding_mask.sum(-1).view(-1, 1, 1, 1)
+    sq = seqlen_q if query_padding_mask is None else query_padding_mask.sum(-1).view(-1, 1, 1, 1)
     if window_size[0] < 0:
         return col_idx > row_idx + sk - sq + window_size[1]
     else:
@@ -716,6 +755,7 @@ def construct_local_mask(
         )
 
 
+@torch.inference_mode()
 def attention_ref(
     q,
     k,
@@ -730,6 +770,7 @@ def attention_ref(
     upcast=True,
     reorder_ops=False,
     use_smooth_softmax=False,
+    fused=False,
 ):
     """
     Arguments:
@@ -743,33 +784,49 @@ def attention_ref(
         causal: whether to apply causal masking
         window_size: (int, int), left and right window size
         upcast: whether to cast all inputs to fp32, do all computation in fp32, then cast
-            output back to fp16/bf16.
+            output back to fp16/bf16. With "partial", the matmuls stay in fp16/bf16 and only the
+            scores and the softmax are computed in fp32.
         reorder_ops: whether to change the order of operations (scaling k instead of scaling k, etc.)
             without changing the math. This is to estimate the numerical error from operation
             reordering.
+        fused: whether to use torch.nn.functional.scaled_dot_product_attention when there is no
+            softcap, smooth softmax or dropout. The attention matrix is not computed in that case.
     Output:
         output: (batch_size, seqlen_q, nheads, head_dim)
-        attention: (batch_size, nheads, seqlen_q, seqlen_k), softmax after dropout
+        attention: (batch_size, nheads, seqlen_q, seqlen_k), softmax after dropout, None if fused
     """
     if causal:
         window_size = (window_size[0], 0)
+    # Keep the (batch_size, seqlen, nheads, head_dim) layout contiguous so that the views below do not copy.
+    q, k, v = (t.contiguous() for t in (q, k, v))
     dtype_og = q.dtype
-    if upcast:
+    partial_upcast = upcast == "partial"
+    if upcast and not partial_upcast:
         q, k, v = q.float(), k.float(), v.float()
-    seqlen_q, seqlen_k = q.shape[1], k.shape[1]
-    k = repeat(k, "b s h d -> b s (h g) d", g=q.shape[2] // k.shape[2])
-    v = repeat(v, "b s h d -> b s (h g) d", g=q.shape[2] // v.shape[2])
-    d = q.shape[-1]
-    if not reorder_ops:
-        scores = torch.einsum("bthd,bshd->bhts", q / math.sqrt(d), k)
+    batch_size, seqlen_q, num_heads, d = q.shape
+    seqlen_k, kv_num_heads = k.shape[1], k.shape[2]
+    # The query heads of a group share the same kv head, so k and v are not repeated.
+    q = q.reshape(batch_size, seqlen_q, kv_num_heads, num_heads // kv_num_heads, d)
+    if fused and softcap <= 0 and not use_smooth_softmax and dropout_p == 0.0 and dropout_mask is None:
+        output = attention_sdpa_ref(q, k, v, query_padding_mask, key_padding_mask, window_size)
+        return output.to(dtype=dtype_og), None
+    # Batched GEMMs per kv head, the query heads of a group are stacked along the query sequence dimension.
+    group_size = num_heads // kv_num_heads
+    q = q.permute(0, 2, 3, 1, 4).reshape(batch_size, kv_num_heads, group_size * seqlen_q, d)
+    k_t = k.permute(0, 2, 3, 1)
+    if partial_upcast:
+        scores = torch.matmul(q, k_t).float() * (1.0 / math.sqrt(d))
+    elif not reorder_ops:
+        scores = torch.matmul(q / math.sqrt(d), k_t)
     else:
-        scores = torch.einsum("bthd,bshd->bhts", q, k / math.sqrt(d))
+        scores = torch.matmul(q, k_t / math.sqrt(d))
+    scores = scores.view(batch_size, num_heads, seqlen_q, seqlen_k)
     if softcap > 0:
         scores = scores / softcap
         scores = scores.tanh()
         scores = scores * softcap
     if key_padding_mask is not None:
-        scores.masked_fill_(rearrange(~key_padding_mask, "b s -> b 1 1 s"), float("-inf"))
+        scores.masked_fill_((~key_padding_mask)[:, None, None, :], float("-inf"))
     if window_size[0] >= 0 or window_size[1] >= 0:
         local_mask = construct_local_mask(
             seqlen_q,
@@ -792,92 +849,360 @@ def attention_ref(
     # We want to mask here so that the attention matrix doesn't have any NaNs
     # Otherwise we'll get NaN in dV
     if query_padding_mask is not None:
-        attention = attention.masked_fill(rearrange(~query_padding_mask, "b s -> b 1 s 1"), 0.0)
+        attention = attention.masked_fill((~query_padding_mask)[:, None, :, None], 0.0)
     dropout_scaling = 1.0 / (1 - dropout_p)
     if dropout_mask is not None:
         attention_drop = attention.masked_fill(~dropout_mask, 0.0)
     else:
         attention_drop = attention
-    output = torch.einsum("bhts,bshd->bthd", attention_drop, v * dropout_scaling)
+    if partial_upcast:
+        attention_drop = attention_drop.to(dtype=v.dtype)
+    output = torch.matmul(
+        attention_drop.reshape(batch_size, kv_num_heads, group_size * seqlen_q, seqlen_k),
+        (v * dropout_scaling).transpose(1, 2),
+    )
+    output = output.view(batch_size, kv_num_heads, group_size, seqlen_q, d).permute(0, 3, 1, 2, 4)
+    output = output.reshape(batch_size, seqlen_q, num_heads, d)
     if query_padding_mask is not None:
-        output.masked_fill_(rearrange(~query_padding_mask, "b s -> b s 1 1"), 0.0)
+        output.masked_fill_((~query_padding_mask)[:, :, None, None], 0.0)
     return output.to(dtype=dtype_og), attention.to(dtype=dtype_og)
 
 
-def rotary_embedding(*args, **kwargs):
-    # Use local import since triton is not available in Windows.
-    from rotary_flash import apply_rotary_emb  # noqa: PLC0415
+def compile_if_available(fn):
+    """
+    Compiles fn with torch.compile when it is available (torch 2.0 or newer) and triton is installed to generate the
+    CUDA kernels, otherwise returns fn unchanged.
+    """
+    if not hasattr(torch, "compile") or importlib.util.find_spec("triton") is None:
+        return fn
+    return torch.compile(fn, dynamic=True)
+
+
+_compiled_attention_ref = compile_if_available(attention_ref)
+
 
-    return apply_rotary_emb(*args, **kwargs)
+def compiled_attention_ref(*args, **kwargs):
+    """Runs attention_ref compiled with torch.compile, softcap and smooth softmax are run eagerly."""
+    if kwargs.get("softcap", 0.0) > 0 or kwargs.get("use_smooth_softmax", False):
+        return attention_ref(*args, **kwargs)
+    return _compiled_attention_ref(*args, **kwargs)
+
+
+def flash_attn_ref(q, k, v, key_padding_mask, window_size, softcap=0.0):
+    """
+    Causal attention computed by FlashAttention-2, which never writes the attention matrix to memory.
+    k and v can have fewer heads than q. key_padding_mask must only mask the end of each sequence, it is passed
+    to flash attention as the cache sequence lengths.
+    """
+    cache_seqlens = None if key_padding_mask is None else key_padding_mask.sum(-1, dtype=torch.int32)
+    return flash_attn_with_kvcache(
+        q,
+        k.contiguous(),
+        v.contiguous(),
+        cache_seqlens=cache_seqlens,
+        causal=True,
+        window_size=window_size,
+        softcap=softcap,
+    )
+
+
+# Reference of the parity checks: "torch" for attention_ref, "flash" for the flash-attn package, or "none" to only
+# run the GQA kernels, e.g. for timing them. The math reference is the default since flash-attn uses the same
+# algorithm as the kernels under test. Set ORT_GQA_TEST_REFERENCE=flash to opt in to flash-attn and
+# ORT_GQA_TEST_SKIP_REF=1 to skip the reference.
+if os.environ.get("ORT_GQA_TEST_SKIP_REF", "0") == "1":
+    default_reference = "none"
+else:
+    default_reference = os.environ.get("ORT_GQA_TEST_REFERENCE", "torch")
+    if default_reference == "flash" and flash_attn_with_kvcache is None:
+        logger.warning("flash-attn 2.6 or newer is not installed, the torch reference is used instead.")
+        default_reference = "torch"
+
+# The torch reference computes everything in fp32. ORT_GQA_TEST_REF_UPCAST=partial keeps its matmuls in fp16/bf16, which
+# is cheaper for timing runs but too close to the kernels under test for the default parity checks.
+reference_upcast = "partial" if os.environ.get("ORT_GQA_TEST_REF_UPCAST") == "partial" else True
+
+
+def _gqa_attention_ref(q, k, v, key_padding_mask, window_size, softcap, use_smooth_softmax, reference):
+    if reference == "flash" and not use_smooth_softmax:
+        return flash_attn_ref(q, k, v, key_padding_mask, window_size, softcap)
+    out, _ = compiled_attention_ref(
+        q,
+        k,
+        v,
+        None,
+        key_padding_mask,
+        0.0,
+        None,
+        causal=True,
+        window_size=window_size,
+        softcap=softcap,
+        upcast=reference_upcast,
+        use_smooth_softmax=use_smooth_softmax,
+        fused=True,
+    )
+    return out
+
+
+@functools.lru_cache(maxsize=4)
+def _captured_gqa_attention_ref(q_shape, k_shape, mask_shape, window_size, softcap, use_smooth_softmax, reference):
+    """
+    Captures _gqa_attention_ref into a CUDA graph for inputs of the given shapes, so that the reference kernels are
+    replayed with a single launch. Returns the graph, its static inputs (q, k, v, key_padding_mask) and its static
+    output, which is overwritten by each replay.
+    """
+    static_inputs = (
+        torch.zeros(q_shape, dtype=torch.float16, device="cuda"),
+        torch.zeros(k_shape, dtype=torch.float16, device="cuda"),
+        torch.zeros(k_shape, dtype=torch.float16, device="cuda"),
+        None if mask_shape is None else torch.ones(mask_shape, dtype=torch.bool, device="cuda"),
+    )
+    # Warm up on a side stream so that compilation, recompilation, autotuning and the cached masks are all done
+    # before the capture, the CUDA graph documentation recommends a few iterations.
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(3):
+            _gqa_attention_ref(*static_inputs, window_size, softcap, use_smooth_softmax, reference)
+    torch.cuda.current_stream().wait_stream(stream)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_output = _gqa_attention_ref(*static_inputs, window_size, softcap, use_smooth_softmax, reference)
+    return graph, static_inputs, static_output
+
+
+def gqa_attention_ref(
+    q, k, v, key_padding_mask, window_size, softcap=0.0, use_smooth_softmax=False, reference=default_reference
+):
+    """
+    Causal reference output of the parity checks. The "flash" reference uses the flash-attn package, except for
+    smooth softmax which it does not support, and the "torch" reference uses attention_ref.
+    Fused references are replayed from a CUDA graph cached per shape. Smooth softmax and softcap in torch materialize
+    the attention matrix and run eagerly instead.
+    """
+    if use_smooth_softmax or (softcap > 0 and reference != "flash"):
+        return _gqa_attention_ref(q, k, v, key_padding_mask, window_size, softcap, use_smooth_softmax, reference)
+    graph, static_inputs, static_output = _captured_gqa_attention_ref(
+        tuple(q.shape),
+        tuple(k.shape),
+        None if key_padding_mask is None else tuple(key_padding_mask.shape),
+        tuple(window_size),
+        softcap,
+        use_smooth_softmax,
+        reference,
+    )
+    for static_input, value in zip(static_inputs, (q, k, v, key_padding_mask), strict=True):
+        if static_input is not None:
+            static_input.copy_(value)
+    graph.replay()
+    # The static output is shared by all the replays of the graph.
+    return static_output.clone()
+
+
+def attention_sdpa_ref(q, k, v, query_padding_mask, key_padding_mask, window_size):
+    """
+    Same as attention_ref without softcap, smooth softmax and dropout, the scores, the masks and the softmax
+    are fused by scaled_dot_product_attention which does not write the attention matrix to memory.
+    q: (batch_size, seqlen_q, kv_num_heads, group_size, head_dim)
+    k: (batch_size, seqlen_k, kv_num_heads, head_dim)
+    v: (batch_size, seqlen_k, kv_num_heads, head_dim)
+    """
+    batch_size, seqlen_q, kv_num_heads, group_size, head_dim = q.shape
+    seqlen_k = k.shape[1]
+    attn_mask = None
+    if key_padding_mask is not None:
+        attn_mask = key_padding_mask[:, None, None, :]
+    if window_size[0] >= 0 or window_size[1] >= 0:
+        local_mask = construct_local_mask(
+            seqlen_q,
+            seqlen_k,
+            window_size,
+            query_padding_mask,
+            key_padding_mask,
+            q.device,
+        )
+        attn_mask = ~local_mask if attn_mask is None else attn_mask & ~local_mask
+    fully_masked = None
+    if attn_mask is not None:
+        attn_mask = attn_mask.expand(batch_size, 1, seqlen_q, seqlen_k)
+        fully_masked = ~attn_mask.any(dim=-1)
+        attn_mask = attn_mask.unsqueeze(2).expand(-1, -1, group_size, -1, -1)
+        attn_mask = attn_mask.reshape(batch_size, 1, group_size * seqlen_q, seqlen_k)
+    # The query heads of a group are stacked along the sequence dimension so that they attend to the same kv head.
+    # The default scale is 1 / sqrt(head_dim) like in attention_ref. k and v are passed as transposed views of the
+    # contiguous BSND tensors, whose last dimension stays contiguous as required by the fused kernels.
+    output = torch.nn.functional.scaled_dot_product_attention(
+        q.permute(0, 2, 3, 1, 4).reshape(batch_size, kv_num_heads, group_size * seqlen_q, head_dim),
+        k.transpose(1, 2),
+        v.transpose(1, 2),
+        attn_mask=attn_mask,
+    )
+    output = output.view(batch_size, kv_num_heads, group_size, seqlen_q, head_dim).permute(0, 3, 1, 2, 4)
+    output = output.reshape(batch_size, seqlen_q, kv_num_heads * group_size, head_dim)
+    if fully_masked is not None:
+        # Some rows might be completely masked out so we fill them with zero instead of NaN
+        output = output.masked_fill(fully_masked.reshape(batch_size, seqlen_q, 1, 1), 0.0)
+    if query_padding_mask is not None:
+        output = output.masked_fill((~query_padding_mask)[:, :, None, None], 0.0)
+    return output
+
+
+@functools.lru_cache(maxsize=32)
+def rotary_cos_sin_cache(max_sequence_length, rotary_dim, seed=0):
+    """
+    Returns the float16 cos and sin caches of shape (max_sequence_length, rotary_dim / 2) on the device.
+    The angles are uniformly random in [0, 2 * pi), drawn from a device generator seeded with seed, so they do not
+    depend on the global torch seed or on the order of the tests.
+    """
+    generator = torch.Generator(device="cuda").manual_seed(seed)
+    angle = torch.rand(max_sequence_length, rotary_dim // 2, device="cuda", generator=generator) * 2 * math.pi
+    return torch.cos(angle).to(dtype=torch.float16), torch.sin(angle).to(dtype=torch.float16)
+
+
+def apply_rope(x, cos, sin, seqlen_offsets=0, interleaved=False):
+    """
+    Torch implementation of rotary_flash.apply_rotary_emb, so that it does not depend on triton.
+    x: (batch_size, seqlen, nheads, headdim)
+    cos, sin: (seqlen_rotary, rotary_dim / 2)
+    seqlen_offsets: (batch_size,) or int. Each sequence in x is shifted by this amount.
+    Positions beyond seqlen_rotary are not rotated.
+    """
+    batch_size, seqlen = x.shape[0], x.shape[1]
+    rotary_dim = cos.shape[-1] * 2
+    positions = torch.arange(seqlen, device=x.device)
+    if isinstance(seqlen_offsets, torch.Tensor):
+        positions = seqlen_offsets.view(-1, 1).to(dtype=positions.dtype) + positions
+    else:
+        positions = (positions + seqlen_offsets).expand(batch_size, seqlen)
+    in_range = (positions < cos.shape[0]).unsqueeze(-1)
+    positions = positions.clamp(max=cos.shape[0] - 1)
+    cos = torch.where(in_range, cos.float()[positions], 1.0).unsqueeze(2)
+    sin = torch.where(in_range, sin.float()[positions], 0.0).unsqueeze(2)
+
+    # Each pair of rotated dimensions is a complex number, multiplied by cos + i * sin.
+    x_ro = x[..., :rotary_dim].float()
+    if interleaved:
+        x_ro = torch.view_as_complex(x_ro.reshape(*x_ro.shape[:-1], rotary_dim // 2, 2).contiguous())
+    else:
+        x_ro = torch.complex(*x_ro.chunk(2, dim=-1))
+    x_ro = x_ro * torch.complex(cos, sin)
+    if interleaved:
+        x_ro = torch.view_as_real(x_ro).flatten(-2)
+    else:
+        x_ro = torch.cat([x_ro.real, x_ro.imag], dim=-1)
+    return torch.cat([x_ro.to(dtype=x.dtype), x[..., rotary_dim:]], dim=-1)
+
+
+@functools.lru_cache(maxsize=32)
+def arange_row(length):
+    """Positions of shape (1, length) on the device."""
+    return torch.arange(length, device="cuda").unsqueeze(0)
+
+
+@functools.lru_cache(maxsize=32)
+def full_seqlens(length, batch_size):
+    """Sequence lengths (batch_size,) all equal to length on the device."""
+    return torch.full((batch_size,), length, device="cuda")
+
+
+@functools.lru_cache(maxsize=32)
+def full_padding_mask(buffer_length, length, batch_size):
+    """Key padding mask (batch_size, buffer_length) of full_seqlens(length, batch_size)."""
+    return arange_row(buffer_length) < full_seqlens(length, batch_size).unsqueeze(1)
+
+
+def _rotary_append_kv(q, new_k, new_v, k_cache, v_cache, cos, sin, cache_seqlens, interleaved, causal):
+    seqlen_offsets = 0 if cache_seqlens is None else cache_seqlens
+    if cos is not None:
+        if causal:
+            q = apply_rope(q, cos, sin, seqlen_offsets, interleaved)
+        else:
+            # All the query tokens are rotated at the position of the first one.
+            batch_size, seqlen, num_heads, head_size = q.shape
+            q = q.reshape(batch_size, 1, seqlen * num_heads, head_size)
+            q = apply_rope(q, cos, sin, seqlen_offsets, interleaved).reshape(batch_size, seqlen, num_heads, head_size)
+        new_k = apply_rope(new_k, cos, sin, seqlen_offsets, interleaved)
+    if cache_seqlens is None:
+        k_cache[:, : new_k.shape[1]].copy_(new_k)
+        v_cache[:, : new_v.shape[1]].copy_(new_v)
+    else:
+        positions = cache_seqlens.view(-1, 1).long() + torch.arange(new_k.shape[1], device=new_k.device)
+        index = positions[:, :, None, None].expand_as(new_k)
+        k_cache.scatter_(1, index, new_k)
+        v_cache.scatter_(1, index, new_v)
+    return q
+
+
+_compiled_rotary_append_kv = compile_if_available(_rotary_append_kv)
+
+
+def rotary_append_kv(q, new_k, new_v, k_cache, v_cache, cos, sin, cache_seqlens, interleaved=False, causal=True):
+    """
+    Reference of the rotary embedding and kv cache update done by the GQA kernel, in a single compiled function.
+    q and new_k are rotated at their positions and new_k and new_v are written in place in k_cache and v_cache
+    (batch_size, seqlen, kv_num_heads, head_size) after the first cache_seqlens tokens of each sequence, or at
+    the start of the caches when cache_seqlens is None. cos and sin are None without rotary. Returns the rotated q.
+    """
+    return _compiled_rotary_append_kv(q, new_k, new_v, k_cache, v_cache, cos, sin, cache_seqlens, interleaved, causal)
+
+
+def assert_close(actual, expected, rtol, atol, err_msg):
+    """Compares tensors on the device, err_msg is appended to the description of the mismatch."""
+    # Copies of the caches are usually bit exact, which is much cheaper to check than the tolerances.
+    if torch.equal(actual, expected):
+        return
+    torch.testing.assert_close(actual, expected, rtol=rtol, atol=atol, equal_nan=True, msg=lambda msg: msg + err_msg)
 
 
 def parity_check_gqa_prompt(
     config: PromptConfig,
     causal=True,
     local=False,
+    left_window_size=None,
     past_format=Formats.BNSH,
     rotary=False,
     rotary_interleaved=False,
     packed=False,
     softcap=0.0,
     use_smooth_softmax=False,
+    reference=default_reference,
     rtol=1e-3,
     atol=1e-3,
 ):
-    q = torch.randn(
-        config.batch_size,
-        config.q_sequence_length,
-        config.num_heads,
-        config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
-    )
-    k = torch.randn(
+    k = sample_fp16(
         config.batch_size,
         config.buffer_sequence_length if past_format == Formats.BSNH else config.kv_num_heads,
         config.kv_num_heads if past_format == Formats.BSNH else config.buffer_sequence_length,
         config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
+        seed=1,
     )
-    v = torch.randn(
+    v = sample_fp16(
         config.batch_size,
         config.buffer_sequence_length if past_format == Formats.BSNH else config.kv_num_heads,
         config.kv_num_heads if past_format == Formats.BSNH else config.buffer_sequence_length,
         config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
-    )
-    new_k = torch.randn(
-        config.batch_size,
-        config.kv_sequence_length,
-        config.kv_num_heads,
-        config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
+        seed=2,
     )
-    new_v = torch.randn(
+    q, new_k, new_v, packed_qkv = randn_qkv(
         config.batch_size,
+        config.q_sequence_length,
         config.kv_sequence_length,
+        config.num_heads,
         config.kv_num_heads,
         config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
+        packed,
     )
 
     window_size = (-1, -1)
-    left_window_size = -1
     if local:
-        left_window_size = random.randint(0, config.kv_sequence_length)
+        if left_window_size is None:
+            left_window_size = config.kv_sequence_length // 2
         window_size = (left_window_size, 0)
-    elif causal:
+    else:
         left_window_size = -1
-        window_size = (-1, 0)
+        if causal:
+            window_size = (-1, 0)
 
     # Pytorch to compare
     k_cache_ref = k.clone()
@@ -885,7 +1210,7 @@ def parity_check_gqa_prompt(
     if past_format == Formats.BNSH:
         k_cache_ref = k_cache_ref.transpose(1, 2)
         v_cache_ref = v_cache_ref.transpose(1, 2)
-    cache_seqlens = torch.tensor([config.kv_sequence_length], device="cuda").repeat(config.batch_size)
+    cache_seqlens = full_seqlens(config.kv_sequence_length, config.batch_size)
     # cache_seqlens = torch.randint(
     #     0,
     #     config.kv_sequence_length,
@@ -894,178 +1219,115 @@ def parity_check_gqa_prompt(
     #     device="cuda",
     # )
     # cache_seqlens[random.randint(0, cache_seqlens.size(dim=0) - 1)] = config.kv_sequence_length
-    rotary_seqlens = torch.tensor([0], device="cuda").repeat(config.batch_size)
 
     if rotary:
         rotary_fraction = 1.0
         rotary_dim = math.floor(int(rotary_fraction * config.head_size) / 16) * 16
-        angle = torch.rand(config.buffer_sequence_length, rotary_dim // 2, device="cuda") * 2 * math.pi
-        cos = torch.cos(angle).to(dtype=torch.float16)
-        sin = torch.sin(angle).to(dtype=torch.float16)
-
-        if causal or local:
-            q_ro = rotary_embedding(q, cos, sin, seqlen_offsets=rotary_seqlens, interleaved=rotary_interleaved)
-        else:
-            q_ro = rearrange(
-                rotary_embedding(
-                    rearrange(q, "b s h d -> b 1 (s h) d"),
-                    cos,
-                    sin,
-                    seqlen_offsets=rotary_seqlens,
-                    interleaved=rotary_interleaved,
-                ),
-                "b 1 (s h) d -> b s h d",
-                s=config.q_sequence_length,
-            )
-        # q_ro = q
-        k_ro = rotary_embedding(new_k, cos, sin, seqlen_offsets=rotary_seqlens, interleaved=rotary_interleaved)
+        cos, sin = rotary_cos_sin_cache(config.buffer_sequence_length, rotary_dim)
     else:
         cos, sin = None, None
-        q_ro, k_ro = q, new_k
-
-    rearrange(torch.arange(config.kv_sequence_length, device="cuda"), "s -> 1 s")
-    arange = rearrange(torch.arange(config.buffer_sequence_length, device="cuda"), "s -> 1 s")
-    cache_seqlens_expanded = rearrange(cache_seqlens, "b -> b 1")
-    kv_seqlens = torch.tensor([config.kv_sequence_length], device="cuda").repeat(config.batch_size)
-    kv_seqlens_expanded = rearrange(kv_seqlens, "b -> b 1")
-    update_mask = arange < kv_seqlens_expanded
-    k_cache_ref[update_mask] = rearrange(k_ro, "b s ... -> (b s) ...")
-    v_cache_ref[update_mask] = rearrange(new_v, "b s ... -> (b s) ...")
-    k_cache_rep = repeat(k_cache_ref, "b s h d -> b s (h g) d", g=config.num_heads // config.kv_num_heads)
-    v_cache_rep = repeat(v_cache_ref, "b s h d -> b s (h g) d", g=config.num_heads // config.kv_num_heads)
-    key_padding_mask = arange < cache_seqlens_expanded
-    out_ref, _ = attention_ref(
-        q_ro,
-        k_cache_rep,
-        v_cache_rep,
-        None,
-        key_padding_mask,
-        0.0,
-        None,
-        causal=True,
-        window_size=window_size,
-        softcap=softcap,
-        use_smooth_softmax=use_smooth_softmax,
+    # The new tokens start at the beginning of the caches in all the batches.
+    q_ro = rotary_append_kv(
+        q, new_k, new_v, k_cache_ref, v_cache_ref, cos, sin, None, rotary_interleaved, causal or local
     )
-    out_ref = out_ref.detach().cpu().numpy()
+
+    key_padding_mask = full_padding_mask(config.buffer_sequence_length, config.kv_sequence_length, config.batch_size)
+    out_ref = None
+    if reference != "none":
+        out_ref = gqa_attention_ref(
+            q_ro,
+            k_cache_ref,
+            v_cache_ref,
+            key_padding_mask,
+            window_size,
+            softcap=softcap,
+            use_smooth_softmax=use_smooth_softmax,
+            reference=reference,
+        )
     if past_format == Formats.BNSH:
         k_cache_ref = k_cache_ref.transpose(1, 2)
         v_cache_ref = v_cache_ref.transpose(1, 2)
 
     # Flash function
     if packed:
-        packed_qkv = torch.concatenate([q, new_k, new_v], dim=2)
-        out, present_k, present_v = gqa_prompt_func(
-            packed_qkv,
-            k,
-            v,
-            config,
-            None,
-            None,
-            cos,
-            sin,
-            cache_seqlens,
-            left_window_size,
-            past_format,
-            True,
-            rotary_interleaved,
-            softcap,
-            use_smooth_softmax=use_smooth_softmax,
-        )
+        query, key, value = packed_qkv, None, None
     else:
-        out, present_k, present_v = gqa_prompt_func(
-            q,
-            k,
-            v,
-            config,
-            new_k,
-            new_v,
-            cos,
-            sin,
-            cache_seqlens,
-            left_window_size,
-            past_format,
-            True,
-            rotary_interleaved,
-            softcap,
-            use_smooth_softmax=use_smooth_softmax,
-        )
-    out = torch.squeeze(out, 0)
-    out = torch.reshape(out, (config.batch_size, config.q_sequence_length, config.num_heads, config.head_size))
-    out = out.detach().cpu().numpy()
+        query, key, value = q, new_k, new_v
+    out, present_k, present_v = gqa_prompt_func(
+        query,
+        k,
+        v,
+        config,
+        key,
+        value,
+        cos,
+        sin,
+        cache_seqlens,
+        left_window_size,
+        past_format,
+        True,
+        rotary_interleaved,
+        softcap,
+        use_smooth_softmax=use_smooth_softmax,
+    )
+    out = out.view(config.batch_size, config.q_sequence_length, config.num_heads, config.head_size)
+
+    if reference == "none":
+        return
 
     err_msg = (
         f" with {config}, causal={causal}, local={local}, past_format={past_format},"
         f" rotary={rotary}, rotary_interleaved={rotary_interleaved}, packed={packed}, softcap={softcap}"
     )
     # Make sure past-present buffer updating correctly
-    numpy.testing.assert_allclose(
-        present_k, k_cache_ref.detach().cpu().numpy(), rtol=rtol, atol=atol, equal_nan=True, err_msg=err_msg
-    )
-    numpy.testing.assert_allclose(
-        present_v, v_cache_ref.detach().cpu().numpy(), rtol=rtol, atol=atol, equal_nan=True, err_msg=err_msg
-    )
+    assert_close(present_k, k_cache_ref, rtol, atol, err_msg)
+    assert_close(present_v, v_cache_ref, rtol, atol, err_msg)
 
-    numpy.testing.assert_allclose(out, out_ref, rtol=rtol, atol=atol, equal_nan=True, err_msg=err_msg)
+    assert_close(out, out_ref, rtol, atol, err_msg)
 
 
 def parity_check_gqa_prompt_no_buff(
     config: PromptConfig,
     causal=True,
     local=False,
+    left_window_size=None,
     past_format=Formats.BNSH,
     rotary=False,
     rotary_interleaved=False,
     packed=False,
     softcap=0.0,
     use_smooth_softmax=False,
+    reference=default_reference,
     rtol=1e-3,
     atol=1e-3,
 ):
-    q = torch.randn(
+    q, new_k, new_v, packed_qkv = randn_qkv(
         config.batch_size,
         config.q_sequence_length,
-        config.num_heads,
-        config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
-    )
-    new_k = torch.randn(
-        config.batch_size,
-        config.kv_sequence_length,
-        config.kv_num_heads,
-        config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
-    )
-    new_v = torch.randn(
-        config.batch_size,
         config.kv_sequence_length,
+        config.num_heads,
         config.kv_num_heads,
         config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
+        packed,
     )
 
     window_size = (-1, -1)
-    left_window_size = -1
     if local:
-        left_window_size = random.randint(0, config.kv_sequence_length)
+        if left_window_size is None:
+            left_window_size = config.kv_sequence_length // 2
         window_size = (left_window_size, 0)
-    elif causal:
+    else:
         left_window_size = -1
-        window_size = (-1, 0)
+        if causal:
+            window_size = (-1, 0)
 
     # Pytorch to compare
-    k_cache_ref = new_k.clone()
-    v_cache_ref = new_v.clone()
+    k_cache_ref = torch.empty_like(new_k)
+    v_cache_ref = torch.empty_like(new_v)
     # if past_format == Formats.BNSH:
     #     k_cache_ref = k_cache_ref.transpose(1, 2)
     #     v_cache_ref = v_cache_ref.transpose(1, 2)
-    cache_seqlens = torch.tensor([config.kv_sequence_length], device="cuda").repeat(config.batch_size)
+    cache_seqlens = full_seqlens(config.kv_sequence_length, config.batch_size)
     # cache_seqlens = torch.randint(
     #     0,
     #     config.kv_sequence_length,
@@ -1074,183 +1336,121 @@ def parity_check_gqa_prompt_no_buff(
     #     device="cuda",
     # )
     # cache_seqlens[random.randint(0, cache_seqlens.size(dim=0) - 1)] = config.kv_sequence_length
-    rotary_seqlens = torch.tensor([0], device="cuda").repeat(config.batch_size)
 
     if rotary:
         rotary_fraction = 1.0
         rotary_dim = math.floor(int(rotary_fraction * config.head_size) / 16) * 16
-        angle = torch.rand(config.kv_sequence_length, rotary_dim // 2, device="cuda") * 2 * math.pi
-        cos = torch.cos(angle).to(dtype=torch.float16)
-        sin = torch.sin(angle).to(dtype=torch.float16)
-
-        if causal or local:
-            q_ro = rotary_embedding(q, cos, sin, seqlen_offsets=rotary_seqlens, interleaved=rotary_interleaved)
-        else:
-            q_ro = rearrange(
-                rotary_embedding(
-                    rearrange(q, "b s h d -> b 1 (s h) d"),
-                    cos,
-                    sin,
-                    seqlen_offsets=rotary_seqlens,
-                    interleaved=rotary_interleaved,
-                ),
-                "b 1 (s h) d -> b s h d",
-                s=config.q_sequence_length,
-            )
-        # q_ro = q
-        k_ro = rotary_embedding(k_cache_ref, cos, sin, seqlen_offsets=rotary_seqlens, interleaved=rotary_interleaved)
+        cos, sin = rotary_cos_sin_cache(config.kv_sequence_length, rotary_dim)
     else:
         cos, sin = None, None
-        q_ro, k_ro = q, k_cache_ref
-    k_cache_ref = k_ro
-
-    brange = rearrange(torch.arange(config.kv_sequence_length, device="cuda"), "s -> 1 s")
-    cache_seqlens_expanded = rearrange(cache_seqlens, "b -> b 1")
-    new_mask = brange < cache_seqlens_expanded
-    k_cache_rep = repeat(k_cache_ref, "b s h d -> b s (h g) d", g=config.num_heads // config.kv_num_heads)
-    v_cache_rep = repeat(v_cache_ref, "b s h d -> b s (h g) d", g=config.num_heads // config.kv_num_heads)
-    out_ref, _ = attention_ref(
-        q_ro,
-        k_cache_rep,
-        v_cache_rep,
-        None,
-        new_mask,
-        0.0,
-        None,
-        causal=True,
-        window_size=window_size,
-        softcap=softcap,
-        use_smooth_softmax=use_smooth_softmax,
+    # There is no past, the rotated new tokens fill the caches from the first position.
+    q_ro = rotary_append_kv(
+        q, new_k, new_v, k_cache_ref, v_cache_ref, cos, sin, None, rotary_interleaved, causal or local
     )
-    out_ref = out_ref.detach().cpu().numpy()
+
+    new_mask = full_padding_mask(config.kv_sequence_length, config.kv_sequence_length, config.batch_size)
+    out_ref = None
+    if reference != "none":
+        out_ref = gqa_attention_ref(
+            q_ro,
+            k_cache_ref,
+            v_cache_ref,
+            new_mask,
+            window_size,
+            softcap=softcap,
+            use_smooth_softmax=use_smooth_softmax,
+            reference=reference,
+        )
     if past_format == Formats.BNSH:
         k_cache_ref = k_cache_ref.transpose(1, 2)
         v_cache_ref = v_cache_ref.transpose(1, 2)
 
     # Flash function
     if packed:
-        packed_qkv = torch.concatenate([q, new_k, new_v], dim=2)
-        out, present_k, present_v = gqa_prompt_func(
-            packed_qkv,
-            None,
-            None,
-            config,
-            None,
-            None,
-            cos,
-            sin,
-            cache_seqlens,
-            left_window_size,
-            past_format,
-            False,
-            rotary_interleaved,
-            softcap,
-            use_smooth_softmax=use_smooth_softmax,
-        )
+        query, key, value = packed_qkv, None, None
     else:
-        out, present_k, present_v = gqa_prompt_func(
-            q,
-            None,
-            None,
-            config,
-            new_k,
-            new_v,
-            cos,
-            sin,
-            cache_seqlens,
-            left_window_size,
-            past_format,
-            False,
-            rotary_interleaved,
-            softcap,
-            use_smooth_softmax=use_smooth_softmax,
-        )
-    out = torch.squeeze(out, 0)
-    out = torch.reshape(out, (config.batch_size, config.q_sequence_length, config.num_heads, config.head_size))
-    out = out.detach().cpu().numpy()
+        query, key, value = q, new_k, new_v
+    out, present_k, present_v = gqa_prompt_func(
+        query,
+        None,
+        None,
+        config,
+        key,
+        value,
+        cos,
+        sin,
+        cache_seqlens,
+        left_window_size,
+        past_format,
+        False,
+        rotary_interleaved,
+        softcap,
+        use_smooth_softmax=use_smooth_softmax,
+    )
+    out = out.view(config.batch_size, config.q_sequence_length, config.num_heads, config.head_size)
+
+    if reference == "none":
+        return
 
     err_msg = (
         f" with {config}, causal={causal}, local={local}, past_format={past_format},"
         f" rotary={rotary}, rotary_interleaved={rotary_interleaved}, packed={packed}, softcap={softcap}, use_smooth_softmax={use_smooth_softmax}"
     )
     # Make sure past-present buffer updating correctly
-    numpy.testing.assert_allclose(
-        present_k, k_cache_ref.detach().cpu().numpy(), rtol=rtol, atol=atol, equal_nan=True, err_msg=err_msg
-    )
-    numpy.testing.assert_allclose(
-        present_v, v_cache_ref.detach().cpu().numpy(), rtol=rtol, atol=atol, equal_nan=True, err_msg=err_msg
-    )
+    assert_close(present_k, k_cache_ref, rtol, atol, err_msg)
+    assert_close(present_v, v_cache_ref, rtol, atol, err_msg)
 
-    numpy.testing.assert_allclose(out, out_ref, rtol=rtol, atol=atol, equal_nan=True, err_msg=err_msg)
+    assert_close(out, out_ref, rtol, atol, err_msg)
 
 
 def parity_check_gqa_past(
     config: Config,
     causal=True,
     local=False,
+    left_window_size=None,
     past_format=Formats.BNSH,
     rotary=False,
     rotary_interleaved=False,
     packed=False,
     softcap=0.0,
     use_smooth_softmax=False,
+    reference=default_reference,
     rtol=1e-3,
     atol=1e-3,
 ):
-    q = torch.randn(
-        config.batch_size,
-        config.sequence_length,
-        config.num_heads,
-        config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
-    )
-    k = torch.randn(
+    k = sample_fp16(
         config.batch_size,
         config.kv_sequence_length if past_format == Formats.BSNH else config.kv_num_heads,
         config.kv_num_heads if past_format == Formats.BSNH else config.kv_sequence_length,
         config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
+        seed=1,
     )
-    v = torch.randn(
+    v = sample_fp16(
         config.batch_size,
         config.kv_sequence_length if past_format == Formats.BSNH else config.kv_num_heads,
         config.kv_num_heads if past_format == Formats.BSNH else config.kv_sequence_length,
         config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
+        seed=2,
     )
-    new_k = torch.randn(
+    q, new_k, new_v, packed_qkv = randn_qkv(
         config.batch_size,
         config.sequence_length,
-        config.kv_num_heads,
-        config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
-    )
-    new_v = torch.randn(
-        config.batch_size,
         config.sequence_length,
+        config.num_heads,
         config.kv_num_heads,
         config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
+        packed,
     )
 
     window_size = (-1, -1)
-    left_window_size = -1
     if local:
-        left_window_size = random.randint(0, config.kv_sequence_length)
+        if left_window_size is None:
+            left_window_size = config.kv_sequence_length // 2
         window_size = (left_window_size, 0)
-    elif causal:
+    else:
         left_window_size = -1
-        window_size = (-1, 0)
+        if causal:
+            window_size = (-1, 0)
 
     # Pytorch to compare
     k_cache_ref = k.clone()
@@ -1269,52 +1469,27 @@ def parity_check_gqa_past(
     if rotary:
         rotary_fraction = 1.0
         rotary_dim = math.floor(int(rotary_fraction * config.head_size) / 16) * 16
-        angle = torch.rand(config.kv_sequence_length, rotary_dim // 2, device="cuda") * 2 * math.pi
-        cos = torch.cos(angle).to(dtype=torch.float16)
-        sin = torch.sin(angle).to(dtype=torch.float16)
-        if causal or local:
-            q_ro = rotary_embedding(q, cos, sin, seqlen_offsets=cache_seqlens, interleaved=rotary_interleaved)
-        else:
-            q_ro = rearrange(
-                rotary_embedding(
-                    rearrange(q, "b s h d -> b 1 (s h) d"),
-                    cos,
-                    sin,
-                    seqlen_offsets=cache_seqlens,
-                    interleaved=rotary_interleaved,
-                ),
-                "b 1 (s h) d -> b s h d",
-                s=config.sequence_length,
-            )
-        k_ro = rotary_embedding(new_k, cos, sin, seqlen_offsets=cache_seqlens, interleaved=rotary_interleaved)
+        cos, sin = rotary_cos_sin_cache(config.kv_sequence_length, rotary_dim)
     else:
         cos, sin = None, None
-        q_ro, k_ro = q, new_k
-
-    arange = rearrange(torch.arange(config.kv_sequence_length, device="cuda"), "s -> 1 s")
-    cache_seqlens_expanded = rearrange(cache_seqlens, "b -> b 1")
-    update_mask = torch.logical_and(
-        cache_seqlens_expanded <= arange, arange < cache_seqlens_expanded + config.sequence_length
+    q_ro = rotary_append_kv(
+        q, new_k, new_v, k_cache_ref, v_cache_ref, cos, sin, cache_seqlens, rotary_interleaved, causal or local
     )
-    k_cache_ref[update_mask] = rearrange(k_ro, "b s ... -> (b s) ...")
-    v_cache_ref[update_mask] = rearrange(new_v, "b s ... -> (b s) ...")
-    k_cache_rep = repeat(k_cache_ref, "b s h d -> b s (h g) d", g=config.num_heads // config.kv_num_heads)
-    v_cache_rep = repeat(v_cache_ref, "b s h d -> b s (h g) d", g=config.num_heads // config.kv_num_heads)
-    key_padding_mask = arange < cache_seqlens_expanded + config.sequence_length
-    out_ref, _ = attention_ref(
-        q_ro,
-        k_cache_rep,
-        v_cache_rep,
-        None,
-        key_padding_mask,
-        0.0,
-        None,
-        causal=True,
-        window_size=window_size,
-        softcap=softcap,
-        use_smooth_softmax=use_smooth_softmax,
-    )
-    out_ref = out_ref.detach().cpu().numpy()
+
+    arange = arange_row(config.kv_sequence_length)
+    key_padding_mask = arange < cache_seqlens.unsqueeze(1) + config.sequence_length
+    out_ref = None
+    if reference != "none":
+        out_ref = gqa_attention_ref(
+            q_ro,
+            k_cache_ref,
+            v_cache_ref,
+            key_padding_mask,
+            window_size,
+            softcap=softcap,
+            use_smooth_softmax=use_smooth_softmax,
+            reference=reference,
+        )
     if past_format == Formats.BNSH:
         k_cache_ref = k_cache_ref.transpose(1, 2)
         v_cache_ref = v_cache_ref.transpose(1, 2)
@@ -1323,128 +1498,90 @@ def parity_check_gqa_past(
 
     # Flash function
     if packed:
-        packed_qkv = torch.concatenate([q, new_k, new_v], dim=2)
-        out, present_k, present_v = gqa_past_func(
-            packed_qkv,
-            k,
-            v,
-            config,
-            None,
-            None,
-            cos,
-            sin,
-            cache_seqlens,
-            past_format,
-            True,
-            left_window_size,
-            rotary_interleaved,
-            softcap,
-            use_smooth_softmax=use_smooth_softmax,
-        )
+        query, key, value = packed_qkv, None, None
     else:
-        out, present_k, present_v = gqa_past_func(
-            q,
-            k,
-            v,
-            config,
-            new_k,
-            new_v,
-            cos,
-            sin,
-            cache_seqlens,
-            past_format,
-            True,
-            left_window_size,
-            rotary_interleaved,
-            softcap,
-            use_smooth_softmax=use_smooth_softmax,
-        )
-    out = torch.squeeze(out, 0)
-    out = torch.reshape(out, (config.batch_size, config.sequence_length, config.num_heads, config.head_size))
-    out = out.detach().cpu().numpy()
+        query, key, value = q, new_k, new_v
+    out, present_k, present_v = gqa_past_func(
+        query,
+        k,
+        v,
+        config,
+        key,
+        value,
+        cos,
+        sin,
+        cache_seqlens,
+        past_format,
+        True,
+        left_window_size,
+        rotary_interleaved,
+        softcap,
+        use_smooth_softmax=use_smooth_softmax,
+    )
+    out = out.view(config.batch_size, config.sequence_length, config.num_heads, config.head_size)
+
+    if reference == "none":
+        return
 
     err_msg = (
         f" with {config}, causal={causal}, local={local}, past_format={past_format},"
         f" rotary={rotary}, rotary_interleaved={rotary_interleaved}, packed={packed}, softcap={softcap}"
     )
     # Make sure past-present buffer updating correctly
-    numpy.testing.assert_allclose(
-        present_k, k_cache_ref.detach().cpu().numpy(), rtol=rtol, atol=atol, equal_nan=True, err_msg=err_msg
-    )
-    numpy.testing.assert_allclose(
-        present_v, v_cache_ref.detach().cpu().numpy(), rtol=rtol, atol=atol, equal_nan=True, err_msg=err_msg
-    )
-    numpy.testing.assert_allclose(out, out_ref, rtol=rtol, atol=atol, equal_nan=True, err_msg=err_msg)
+    assert_close(present_k, k_cache_ref, rtol, atol, err_msg)
+    assert_close(present_v, v_cache_ref, rtol, atol, err_msg)
+    assert_close(out, out_ref, rtol, atol, err_msg)
 
 
 def parity_check_gqa_past_no_buff(
     config: Config,
     causal=True,
     local=False,
+    left_window_size=None,
     past_format=Formats.BNSH,
     rotary=False,
     rotary_interleaved=False,
     packed=False,
     softcap=0.0,
     use_smooth_softmax=False,
+    reference=default_reference,
     rtol=1e-3,
     atol=1e-3,
 ):
     torch.manual_seed(69)
-    q = torch.randn(
-        config.batch_size,
-        config.sequence_length,
-        config.num_heads,
-        config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
-    )
-    k = torch.randn(
+    k = sample_fp16(
         config.batch_size,
         config.kv_sequence_length if past_format == Formats.BSNH else config.kv_num_heads,
         config.kv_num_heads if past_format == Formats.BSNH else config.kv_sequence_length,
         config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
+        seed=1,
     )
-    v = torch.randn(
+    v = sample_fp16(
         config.batch_size,
         config.kv_sequence_length if past_format == Formats.BSNH else config.kv_num_heads,
         config.kv_num_heads if past_format == Formats.BSNH else config.kv_sequence_length,
         config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
+        seed=2,
     )
-    new_k = torch.randn(
+    q, new_k, new_v, packed_qkv = randn_qkv(
         config.batch_size,
         config.sequence_length,
-        config.kv_num_heads,
-        config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
-    )
-    new_v = torch.randn(
-        config.batch_size,
         config.sequence_length,
+        config.num_heads,
         config.kv_num_heads,
         config.head_size,
-        device="cuda",
-        dtype=torch.float16,
-        requires_grad=False,
+        packed,
     )
 
     window_size = (-1, -1)
-    left_window_size = -1
     if local:
-        left_window_size = random.randint(0, config.kv_sequence_length)
+        if left_window_size is None:
+            left_window_size = config.kv_sequence_length // 2
         window_size = (left_window_size, 0)
-    elif causal:
+    else:
         left_window_size = -1
-        window_size = (-1, 0)
+        if causal:
+            window_size = (-1, 0)
 
     # Pytorch to compare
     k_cache_ref = k.clone()
@@ -1466,54 +1603,27 @@ def parity_check_gqa_past_no_buff(
     if rotary:
         rotary_fraction = 1.0
         rotary_dim = math.floor(int(rotary_fraction * config.head_size) / 16) * 16
-        angle = (
-            torch.rand(config.kv_sequence_length + config.sequence_length, rotary_dim // 2, device="cuda") * 2 * math.pi
-        )
-        cos = torch.cos(angle).to(dtype=torch.float16)
-        sin = torch.sin(angle).to(dtype=torch.float16)
-        if causal or local:
-            q_ro = rotary_embedding(q, cos, sin, seqlen_offsets=cache_seqlens, interleaved=rotary_interleaved)
-        else:
-            q_ro = rearrange(
-                rotary_embedding(
-                    rearrange(q, "b s h d -> b 1 (s h) d"),
-                    cos,
-                    sin,
-                    seqlen_offsets=cache_seqlens,
-                    interleaved=rotary_interleaved,
-                ),
-                "b 1 (s h) d -> b s h d",
-                s=config.sequence_length,
-            )
-        k_ro = rotary_embedding(new_k, cos, sin, seqlen_offsets=cache_seqlens, interleaved=rotary_interleaved)
+        cos, sin = rotary_cos_sin_cache(config.kv_sequence_length + config.sequence_length, rotary_dim)
     else:
         cos, sin = None, None
-        q_ro, k_ro = q, new_k
-
-    arange = rearrange(torch.arange(config.kv_sequence_length + config.sequence_length, device="cuda"), "s -> 1 s")
-    cache_seqlens_expanded = rearrange(cache_seqlens, "b -> b 1")
-    update_mask = torch.logical_and(
-        cache_seqlens_expanded <= arange, arange < cache_seqlens_expanded + config.sequence_length
+    q_ro = rotary_append_kv(
+        q, new_k, new_v, k_cache_ref, v_cache_ref, cos, sin, cache_seqlens, rotary_interleaved, causal or local
     )
-    k_cache_ref[update_mask] = rearrange(k_ro, "b s ... -> (b s) ...")
-    v_cache_ref[update_mask] = rearrange(new_v, "b s ... -> (b s) ...")
-    k_cache_rep = repeat(k_cache_ref, "b s h d -> b s (h g) d", g=config.num_heads // config.kv_num_heads)
-    v_cache_rep = repeat(v_cache_ref, "b s h d -> b s (h g) d", g=config.num_heads // config.kv_num_heads)
-    key_padding_mask = arange < cache_seqlens_expanded + config.sequence_length
-    out_ref, _ = attention_ref(
-        q_ro,
-        k_cache_rep,
-        v_cache_rep,
-        None,
-        key_padding_mask,
-        0.0,
-        None,
-        causal=True,
-        window_size=window_size,
-        softcap=softcap,
-        use_smooth_softmax=use_smooth_softmax,
-    )
-    out_ref = out_ref.detach().cpu().numpy()
+
+    arange = arange_row(config.kv_sequence_length + config.sequence_length)
+    key_padding_mask = arange < cache_seqlens.unsqueeze(1) + config.sequence_length
+    out_ref = None
+    if reference != "none":
+        out_ref = gqa_attention_ref(
+            q_ro,
+            k_cache_ref,
+            v_cache_ref,
+            key_padding_mask,
+            window_size,
+            softcap=softcap,
+            use_smooth_softmax=use_smooth_softmax,
+            reference=reference,
+        )
     if past_format == Formats.BNSH:
         k_cache_ref = k_cache_ref.transpose(1, 2)
         v_cache_ref = v_cache_ref.transpose(1, 2)
@@ -1522,70 +1632,45 @@ def parity_check_gqa_past_no_buff(
 
     # Flash function
     if packed:
-        packed_qkv = torch.concatenate([q, new_k, new_v], dim=2)
-        out, present_k, present_v = gqa_past_func(
-            packed_qkv,
-            k,
-            v,
-            config,
-            None,
-            None,
-            cos,
-            sin,
-            cache_seqlens,
-            past_format,
-            False,
-            window_size=left_window_size,
-            rotary_interleaved=rotary_interleaved,
-            softcap=softcap,
-            use_smooth_softmax=use_smooth_softmax,
-        )
+        query, key, value = packed_qkv, None, None
     else:
-        out, present_k, present_v = gqa_past_func(
-            q,
-            k,
-            v,
-            config,
-            new_k,
-            new_v,
-            cos,
-            sin,
-            cache_seqlens,
-            past_format,
-            False,
-            window_size=left_window_size,
-            rotary_interleaved=rotary_interleaved,
-            softcap=softcap,
-            use_smooth_softmax=use_smooth_softmax,
-        )
-    out = torch.squeeze(out, 0)
-    out = torch.reshape(out, (config.batch_size, config.sequence_length, config.num_heads, config.head_size))
-    out = out.detach().cpu().numpy()
+        query, key, value = q, new_k, new_v
+    out, present_k, present_v = gqa_past_func(
+        query,
+        k,
+        v,
+        config,
+        key,
+        value,
+        cos,
+        sin,
+        cache_seqlens,
+        past_format,
+        False,
+        window_size=left_window_size,
+        rotary_interleaved=rotary_interleaved,
+        softcap=softcap,
+        use_smooth_softmax=use_smooth_softmax,
+    )
+    out = out.view(config.batch_size, config.sequence_length, config.num_heads, config.head_size)
+
+    if reference == "none":
+        return
 
     err_msg = (
         f" with {config}, causal={causal}, local={local}, past_format={past_format},"
         f" rotary={rotary}, rotary_interleaved={rotary_interleaved}, packed={packed}, softcap={softcap}"
     )
-    for b in range(config.batch_size):
-        numpy.testing.assert_allclose(
-            present_k[b, :, : (cache_seqlens + 1)[b]],
-            k_cache_ref[b, :, : (cache_seqlens + 1)[b]].detach().cpu().numpy(),
-            rtol=rtol,
-            atol=atol,
-            equal_nan=True,
-            err_msg=err_msg,
-        )
-        numpy.testing.assert_allclose(
-            present_v[b, :, : (cache_seqlens + 1)[b]],
-            v_cache_ref[b, :, : (cache_seqlens + 1)[b]].detach().cpu().numpy(),
-            rtol=rtol,
-            atol=atol,
-            equal_nan=True,
-            err_msg=err_msg,
-        )
-    numpy.testing.assert_allclose(out, out_ref, rtol=rtol, atol=atol, equal_nan=True, err_msg=err_msg)
+    # Only the first cache_seqlens + 1 tokens of each sequence are compared, the rest of present is not written.
+    seq_dim = 2 if past_format == Formats.BNSH else 1
+    valid = arange_row(present_k.shape[seq_dim]) < (cache_seqlens + 1).unsqueeze(1)
+    valid = valid[:, None, :, None] if past_format == Formats.BNSH else valid[:, :, None, None]
+    assert_close(present_k.masked_fill(~valid, 0.0), k_cache_ref.masked_fill(~valid, 0.0), rtol, atol, err_msg)
+    assert_close(present_v.masked_fill(~valid, 0.0), v_cache_ref.masked_fill(~valid, 0.0), rtol, atol, err_msg)
+    assert_close(out, out_ref, rtol, atol, err_msg)
 
 
+@functools.cache
 def has_flash_attention():
     if not torch.cuda.is_available():
         return False
@@ -1598,6 +1683,7 @@ def has_flash_attention():
     )
 
 
+@functools.cache
 def has_memory_efficient():
     if not torch.cuda.is_available():
         return False
@@ -1609,276 +1695,203 @@ def has_memory_efficient():
     return True
 
 
-def gqa_no_past_memory_efficient_test_cases():
-    batches = [3] if pipeline_mode else [1, 3, 5]
-    seqs = (
-        [
-            (2000, 2000),
-        ]
-        if pipeline_mode
-        else [
-            (127, 127),
-            (35, 35),
-            (2000, 2000),
-            (200, 200),
-            (240, 240),
-        ]
-    )
-    num_h = [(9, 3)] if pipeline_mode else [(6, 6), (6, 3), (9, 9), (9, 3)]
-    h_sizes = [128] if pipeline_mode else [32, 40, 64, 80, 96, 128, 160, 192, 224, 256]
-    torch.manual_seed(69)
+def cached_test_cases(generator):
+    """Builds the cases yielded by generator once, the test modules expanding them share the same tuple."""
 
-    for b in batches:
-        for sq, skv in seqs:
-            for n, n2 in num_h:
-                for h in h_sizes:
-                    for local in [False, True]:
-                        for rotary, rotary_interleaved in rotary_options_for_current_os():
-                            for packed in [False, True]:
-                                for softcap in [0.0, 50.0]:
-                                    config = PromptConfig(b, sq, skv, sq + skv + 8, n, n2, h)
-                                    if rotary and h % 16 > 0:
-                                        continue
-                                    yield (
-                                        str(config) + f"{local}_{rotary}_{rotary_interleaved}_{packed}",
-                                        config,
-                                        local,
-                                        rotary,
-                                        rotary_interleaved,
-                                        packed,
-                                        softcap,
-                                    )
+    @functools.cache
+    @functools.wraps(generator)
+    def cases():
+        return tuple(generator())
 
+    return cases
 
-def gqa_no_past_flash_attention_test_cases():
-    batches = [3] if pipeline_mode else [1, 3, 5]
-    seqs = (
-        [
-            (240, 240),
-        ]
-        if pipeline_mode
-        else [
-            (127, 127),
-            (35, 35),
-            (2000, 2000),
-            (200, 200),
-            (240, 240),
-        ]
-    )
-    num_h = [(32, 8)] if pipeline_mode else [(6, 6), (6, 3), (9, 9), (9, 3)]
-    h_sizes = [128] if pipeline_mode else [32, 40, 64, 80, 96, 128, 160, 192, 224, 256]
-    torch.manual_seed(69)
 
-    for b in batches:
-        for sq, skv in seqs:
-            for n, n2 in num_h:
-                for h in h_sizes:
-                    for local in [False, True]:
-                        for rotary, rotary_interleaved in rotary_options_for_current_os():
-                            for packed in [False, True]:
-                                for softcap in [0.0, 50.0]:
-                                    if rotary and h % 16 > 0:
-                                        continue
-
-                                    config = PromptConfig(b, sq, skv, sq + skv + 8, n, n2, h)
-                                    yield (
-                                        str(config) + f"{local}_{rotary}_{rotary_interleaved}_{packed}_{softcap}",
-                                        config,
-                                        local,
-                                        rotary,
-                                        rotary_interleaved,
-                                        packed,
-                                        softcap,
-                                    )
+def local_window_sizes(kv_sequence_length):
+    """Left window sizes covered by the test cases, -1 disables local attention."""
+    if pipeline_mode:
+        return [-1, kv_sequence_length // 2]
+    return [-1, 0, kv_sequence_length // 4, kv_sequence_length // 2, kv_sequence_length - 1]
+
 
+class GqaCase(NamedTuple):
+    """Arguments of a parameterized GQA test, name is used by parameterized to name the test."""
+
+    name: str
+    config: Config | PromptConfig
+    window: int
+    rotary: bool
+    rotary_interleaved: bool
+    packed: bool
+    softcap: float
+
+
+def _make_cases(batches, seqs, num_h, h_sizes, prompt=False, local=True, softcaps=(0.0, 50.0)):
+    """
+    Yields the GqaCase of all the combinations of the options. The local window sizes are only iterated when local
+    is True, the window is -1 otherwise. prompt builds PromptConfig instead of Config.
+    """
+    # Rotary requires the head size to be a multiple of 16, the other head sizes are only paired with no rotary.
+    # Rotary is fused in the kernels, every rotary layout is tested with softcap 0 as in most models. The rotary layout
+    # does not change the softcap path, so the non-zero softcaps are only paired with non-interleaved rotary.
+    head_options = [
+        (h, rotary, rotary_interleaved, softcap)
+        for h in h_sizes
+        for rotary, rotary_interleaved in ROTARY_OPTIONS
+        if not rotary or h % 16 == 0
+        for softcap in softcaps
+        if not (rotary_interleaved and softcap > 0.0)
+    ]
+    for b, (s, s2), (n, n2), (h, rotary, rotary_interleaved, softcap), packed in itertools.product(
+        batches, seqs, num_h, head_options, [False, True]
+    ):
+        config = PromptConfig(b, s, s2, s + s2 + 8, n, n2, h) if prompt else Config(b, s, s2, n, n2, h)
+        prefix = str(config)
+        for window in local_window_sizes(s2) if local else [-1]:
+            yield GqaCase(
+                f"{prefix}{window}_{rotary}_{rotary_interleaved}_{packed}_{softcap}",
+                config,
+                window,
+                rotary,
+                rotary_interleaved,
+                packed,
+                softcap,
+            )
+
+
+_PROMPT_SEQS = [(127, 127), (35, 35), (2000, 2000), (200, 200), (240, 240)]
+_PAST_SEQS = [
+    (1, 128),
+    (1, 339),
+    (1, 1024),
+    (1, 5000),
+    (1, 800),
+    (1, 256),
+    (1, 799),
+    (1, 2048),
+    # (1, 128 * 512),
+    # (16, 128 * 512),
+    # (128, 128),
+]
+_INTERACTIVE_SEQS = [
+    (1, 128),
+    (32, 128),
+    (128, 2048),
+    (1235, 5000),
+    (40, 800),
+    (1, 256),
+    (2, 799),
+    (41, 2048),
+    # (1, 128 * 512),
+    # (16, 128 * 512),
+    # (128, 128),
+]
+_NUM_HEADS = [(6, 6), (6, 3), (9, 9), (9, 3)]
+
+# (batches, seqs, num_h, h_sizes) of each group of test cases, in the pipeline and outside of it.
+_PROFILES = {
+    "no_past_memory_efficient": {
+        "pipeline": ([3], [(2000, 2000)], [(9, 3)], [128]),
+        "full": ([1, 3, 5], _PROMPT_SEQS, _NUM_HEADS, sweep_head_sizes),
+    },
+    "no_past_flash_attention": {
+        "pipeline": ([3], [(240, 240)], [(32, 8)], [128]),
+        "full": ([1, 3, 5], _PROMPT_SEQS, _NUM_HEADS, sweep_head_sizes),
+    },
+    "past_memory_efficient": {
+        "pipeline": ([5], [(1, 1024)], [(32, 8)], [256]),
+        "full": ([1, 3, 5], _PAST_SEQS, _NUM_HEADS, sweep_head_sizes),
+    },
+    "past_flash_attention": {
+        "pipeline": ([5], [(1, 2048)], [(32, 8)], [256]),
+        "full": ([1, 3, 5], _PAST_SEQS, _NUM_HEADS, sweep_head_sizes),
+    },
+    "interactive_flash_attention": {
+        "pipeline": ([1], [(128, 2048)], [(9, 3)], [64]),
+        "full": ([1], _INTERACTIVE_SEQS, _NUM_HEADS, sweep_head_sizes),
+    },
+    "interactive_memory_efficient": {
+        "pipeline": ([1], [(32, 128)], [(9, 3)], [64]),
+        "full": ([1], _INTERACTIVE_SEQS, _NUM_HEADS, sweep_head_sizes),
+    },
+}
+
+
+def case_profile(name):
+    """Returns the (batches, seqs, num_h, h_sizes) of the named group of test cases for the current mode."""
+    return _PROFILES[name]["pipeline" if pipeline_mode else "full"]
+
+
+@cached_test_cases
+def gqa_no_past_memory_efficient_test_cases():
+    return _make_cases(*case_profile("no_past_memory_efficient"), prompt=True)
+
+
+@cached_test_cases
+def gqa_no_past_flash_attention_test_cases():
+    return _make_cases(*case_profile("no_past_flash_attention"), prompt=True)
 
+
+@cached_test_cases
 def gqa_past_memory_efficient_test_cases():
-    batches = [5] if pipeline_mode else [1, 3, 5]
-    seqs = (
-        [(1, 1024)]
-        if pipeline_mode
-        else [
-            (1, 128),
-            (1, 339),
-            (1, 1024),
-            (1, 5000),
-            (1, 800),
-            (1, 256),
-            (1, 799),
-            (1, 2048),
-            # (1, 128 * 512),
-            # (16, 128 * 512),
-            # (128, 128),
-        ]
-    )
-    num_h = [(32, 8)] if pipeline_mode else [(6, 6), (6, 3), (9, 9), (9, 3)]
-    h_sizes = [256] if pipeline_mode else [32, 40, 64, 80, 96, 128, 160, 192, 224, 256]
-    random.seed(69)
-
-    for b in batches:
-        for s, s2 in seqs:
-            for n, n2 in num_h:
-                for h in h_sizes:
-                    for local in [False, True]:
-                        for rotary, rotary_interleaved in rotary_options_for_current_os():
-                            for packed in [False, True]:
-                                for softcap in [0.0, 50.0]:
-                                    if rotary and h % 16 > 0:
-                                        continue
-                                    config = Config(b, s, s2, n, n2, h)
-                                    yield (
-                                        str(config) + f"{local}_{rotary}_{rotary_interleaved}_{packed}_{softcap}",
-                                        config,
-                                        local,
-                                        rotary,
-                                        rotary_interleaved,
-                                        packed,
-                                        softcap,
-                                    )
+    return _make_cases(*case_profile("past_memory_efficient"))
 
 
+@cached_test_cases
 def gqa_past_flash_attention_test_cases():
-    batches = [5] if pipeline_mode else [1, 3, 5]
-    seqs = (
-        [(1, 2048)]
-        if pipeline_mode
-        else [
-            (1, 128),
-            (1, 339),
-            (1, 1024),
-            (1, 5000),
-            (1, 800),
-            (1, 256),
-            (1, 799),
-            (1, 2048),
-            # (1, 128 * 512),
-            # (16, 128 * 512),
-            # (128, 128),
-        ]
-    )
-    num_h = [(32, 8)] if pipeline_mode else [(6, 6), (6, 3), (9, 9), (9, 3)]
-    h_sizes = [256] if pipeline_mode else [32, 40, 64, 80, 96, 128, 160, 192, 224, 256]
-    random.seed(69)
-
-    for b in batches:
-        for s, s2 in seqs:
-            for n, n2 in num_h:
-                for h in h_sizes:
-                    for local in [False, True]:
-                        for rotary, rotary_interleaved in rotary_options_for_current_os():
-                            for packed in [False, True]:
-                                for softcap in [0.0, 50.0]:
-                                    if rotary and h % 16 > 0:
-                                        continue
-
-                                    config = Config(b, s, s2, n, n2, h)
-                                    yield (
-                                        str(config) + f"{local}_{rotary}_{rotary_interleaved}_{packed}_{softcap}",
-                                        config,
-                                        local,
-                                        rotary,
-                                        rotary_interleaved,
-                                        packed,
-                                        softcap,
-                                    )
+    return _make_cases(*case_profile("past_flash_attention"))
 
 
+@cached_test_cases
 def gqa_interactive_one_batch_flash_attention_test_cases():
-    batches = [1]
-    seqs = (
-        [(128, 2048)]
-        if pipeline_mode
-        else [
-            (1, 128),
-            (32, 128),
-            (128, 2048),
-            (1235, 5000),
-            (40, 800),
-            (1, 256),
-            (2, 799),
-            (41, 2048),
-            # (1, 128 * 512),
-            # (16, 128 * 512),
-            # (128, 128),
-        ]
-    )
-    num_h = [(9, 3)] if pipeline_mode else [(6, 6), (6, 3), (9, 9), (9, 3)]
-    h_sizes = [64] if pipeline_mode else [32, 40, 64, 80, 96, 128, 160, 192, 224, 256]
-    random.seed(69)
-
-    for b in batches:
-        for s, s2 in seqs:
-            for n, n2 in num_h:
-                for h in h_sizes:
-                    for local in [False, True]:
-                        for rotary, rotary_interleaved in rotary_options_for_current_os():
-                            for packed in [False, True]:
-                                if rotary and h % 16 > 0:
-                                    continue
-
-                                config = Config(b, s, s2, n, n2, h)
-                                yield (
-                                    str(config) + f"{local}_{rotary}_{rotary_interleaved}_{packed}",
-                                    config,
-                                    local,
-                                    rotary,
-                                    rotary_interleaved,
-                                    packed,
-                                )
+    return _make_cases(*case_profile("interactive_flash_attention"), softcaps=(0.0,))
 
 
+@cached_test_cases
 def gqa_interactive_one_batch_memory_efficient_attention_test_cases():
-    batches = [1]
-    seqs = (
-        [(32, 128)]
-        if pipeline_mode
-        else [
-            (1, 128),
-            (32, 128),
-            (128, 2048),
-            (1235, 5000),
-            (40, 800),
-            (1, 256),
-            (2, 799),
-            (41, 2048),
-            # (1, 128 * 512),
-            # (16, 128 * 512),
-            # (128, 128),
-        ]
-    )
-    num_h = [(9, 3)] if pipeline_mode else [(6, 6), (6, 3), (9, 9), (9, 3)]
-    h_sizes = [64] if pipeline_mode else [32, 40, 64, 80, 96, 128, 160, 192, 224, 256]
-    random.seed(69)
-
-    for b in batches:
-        for s, s2 in seqs:
-            for n, n2 in num_h:
-                for h in h_sizes:
-                    for rotary, rotary_interleaved in rotary_options_for_current_os():
-                        for packed in [False, True]:
-                            if rotary and h % 16 > 0:
-                                continue
-
-                            config = Config(b, s, s2, n, n2, h)
-                            yield (
-                                str(config) + f"{rotary}_{rotary_interleaved}_{packed}",
-                                config,
-                                rotary,
-                                rotary_interleaved,
-                                packed,
-                            )
+    return _make_cases(*case_profile("interactive_memory_efficient"), local=False, softcaps=(0.0,))
+
+
+def cases_if(available, generator):
+    """Cases of generator if the backend it tests is available, they are not built otherwise."""
+    return generator() if available else ()
+
+
+class GqaTestCase(unittest.TestCase):
+    """Sets ORT_DISABLE_FLASH_ATTENTION to disable_flash_attention while the tests of a subclass run."""
+
+    disable_flash_attention = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls._disable_flash_attention = os.environ.get("ORT_DISABLE_FLASH_ATTENTION")
+        if cls.disable_flash_attention is not None:
+            os.environ["ORT_DISABLE_FLASH_ATTENTION"] = cls.disable_flash_attention
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls._disable_flash_attention is None:
+            os.environ.pop("ORT_DISABLE_FLASH_ATTENTION", None)
+        else:
+            os.environ["ORT_DISABLE_FLASH_ATTENTION"] = cls._disable_flash_attention
+
+    def setUp(self):
+        # Seeded per test so the random past lengths of the past checks do not depend on the test order.
+        random.seed(69)
+        torch.manual_seed(69)
 
 
 @unittest.skipIf(not has_flash_attention(), reason="Flash Attention is not available, skipping tests.")
-class TestFlashGQA(unittest.TestCase):
-    @parameterized.expand(gqa_no_past_flash_attention_test_cases())
-    def test_gqa_no_past_flash_attention(self, _, config, local, rotary, rotary_interleaved, packed, softcap):
-        print("------- FLASH ATTENTION (PROMPT CASE) --------")
-        os.environ["ORT_DISABLE_FLASH_ATTENTION"] = "0"
+class TestFlashGQA(GqaTestCase):
+    disable_flash_attention = "0"
+
+    @parameterized.expand(cases_if(has_flash_attention(), gqa_no_past_flash_attention_test_cases), skip_on_empty=True)
+    def test_gqa_no_past_flash_attention(self, _, config, window, rotary, rotary_interleaved, packed, softcap):
+        logger.debug("FLASH ATTENTION (PROMPT CASE)")
 
         parity_check_gqa_prompt(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rotary=rotary,
             rotary_interleaved=rotary_interleaved,
@@ -1888,7 +1901,8 @@ class TestFlashGQA(unittest.TestCase):
         )
         parity_check_gqa_prompt_no_buff(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rotary=rotary,
             rotary_interleaved=rotary_interleaved,
@@ -1897,14 +1911,14 @@ class TestFlashGQA(unittest.TestCase):
             use_smooth_softmax=False,
         )
 
-    @parameterized.expand(gqa_past_flash_attention_test_cases())
-    def test_gqa_past_flash_attention(self, _, config, local, rotary, rotary_interleaved, packed, softcap):
-        print("------- FLASH ATTENTION (TOKEN GEN) -------")
-        os.environ["ORT_DISABLE_FLASH_ATTENTION"] = "0"
+    @parameterized.expand(cases_if(has_flash_attention(), gqa_past_flash_attention_test_cases), skip_on_empty=True)
+    def test_gqa_past_flash_attention(self, _, config, window, rotary, rotary_interleaved, packed, softcap):
+        logger.debug("FLASH ATTENTION (TOKEN GEN)")
 
         parity_check_gqa_past(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rtol=1e-3,
             atol=1e-3,
@@ -1916,7 +1930,8 @@ class TestFlashGQA(unittest.TestCase):
         )
         parity_check_gqa_past_no_buff(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rtol=1e-3,
             atol=1e-3,
@@ -1927,43 +1942,53 @@ class TestFlashGQA(unittest.TestCase):
             use_smooth_softmax=True,
         )
 
-    @parameterized.expand(gqa_interactive_one_batch_flash_attention_test_cases())
-    def test_gqa_interactive_one_batch_flash_attention(self, _, config, local, rotary, rotary_interleaved, packed):
-        print("------- FLASH ATTENTION (INTERACTIVE) -------")
-        os.environ["ORT_DISABLE_FLASH_ATTENTION"] = "0"
+    @parameterized.expand(
+        cases_if(has_flash_attention(), gqa_interactive_one_batch_flash_attention_test_cases),
+        skip_on_empty=True,
+    )
+    def test_gqa_interactive_one_batch_flash_attention(
+        self, _, config, window, rotary, rotary_interleaved, packed, softcap
+    ):
+        logger.debug("FLASH ATTENTION (INTERACTIVE)")
 
         parity_check_gqa_past(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rtol=5e-3,
             atol=5e-3,
             rotary=rotary,
             rotary_interleaved=rotary_interleaved,
             packed=packed,
+            softcap=softcap,
         )
         parity_check_gqa_past_no_buff(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rtol=5e-3,
             atol=5e-3,
             rotary=rotary,
             rotary_interleaved=rotary_interleaved,
             packed=packed,
+            softcap=softcap,
         )
 
 
 @unittest.skipIf(not has_memory_efficient(), reason="Memory efficient FMHA is not available, skipping tests.")
-class TestMemoryEfficientGQA(unittest.TestCase):
-    @parameterized.expand(gqa_no_past_memory_efficient_test_cases())
-    def test_gqa_no_past_memory_efficient(self, _, config, local, rotary, rotary_interleaved, packed, softcap):
-        os.environ["ORT_DISABLE_FLASH_ATTENTION"] = "1"
-        print("------- MEMORY EFFICIENT ATTENTION (PROMPT CASE) ---------")
+class TestMemoryEfficientGQA(GqaTestCase):
+    disable_flash_attention = "1"
+
+    @parameterized.expand(cases_if(has_memory_efficient(), gqa_no_past_memory_efficient_test_cases), skip_on_empty=True)
+    def test_gqa_no_past_memory_efficient(self, _, config, window, rotary, rotary_interleaved, packed, softcap):
+        logger.debug("MEMORY EFFICIENT ATTENTION (PROMPT CASE)")
 
         parity_check_gqa_prompt(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             rtol=5e-3,
             atol=5e-3,
             past_format=Formats.BNSH,
@@ -1975,7 +2000,8 @@ class TestMemoryEfficientGQA(unittest.TestCase):
         )
         parity_check_gqa_prompt_no_buff(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             rtol=5e-3,
             atol=5e-3,
             past_format=Formats.BNSH,
@@ -1986,14 +2012,14 @@ class TestMemoryEfficientGQA(unittest.TestCase):
             use_smooth_softmax=True,
         )
 
-    @parameterized.expand(gqa_past_memory_efficient_test_cases())
-    def test_gqa_past_memory_efficient(self, _, config, local, rotary, rotary_interleaved, packed, softcap):
-        os.environ["ORT_DISABLE_FLASH_ATTENTION"] = "1"
-        print("-------- MEMORY EFFICIENT (TOKEN GEN) --------")
+    @parameterized.expand(cases_if(has_memory_efficient(), gqa_past_memory_efficient_test_cases), skip_on_empty=True)
+    def test_gqa_past_memory_efficient(self, _, config, window, rotary, rotary_interleaved, packed, softcap):
+        logger.debug("MEMORY EFFICIENT (TOKEN GEN)")
 
         parity_check_gqa_past(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rtol=1e-3,
             atol=1e-3,
@@ -2005,7 +2031,8 @@ class TestMemoryEfficientGQA(unittest.TestCase):
         )
         parity_check_gqa_past_no_buff(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rtol=1e-3,
             atol=1e-3,
@@ -2016,28 +2043,38 @@ class TestMemoryEfficientGQA(unittest.TestCase):
             use_smooth_softmax=False,
         )
 
-    @parameterized.expand(gqa_interactive_one_batch_memory_efficient_attention_test_cases())
-    def test_gqa_interactive_one_batch_memory_efficient_attention(self, _, config, rotary, rotary_interleaved, packed):
-        os.environ["ORT_DISABLE_FLASH_ATTENTION"] = "1"
-        print("-------- MEMORY EFFICIENT (INTERACTIVE) --------")
+    @parameterized.expand(
+        cases_if(has_memory_efficient(), gqa_interactive_one_batch_memory_efficient_attention_test_cases),
+        skip_on_empty=True,
+    )
+    def test_gqa_interactive_one_batch_memory_efficient_attention(
+        self, _, config, window, rotary, rotary_interleaved, packed, softcap
+    ):
+        logger.debug("MEMORY EFFICIENT (INTERACTIVE)")
 
         parity_check_gqa_past(
             config,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rtol=5e-3,
             atol=5e-3,
             rotary=rotary,
             rotary_interleaved=rotary_interleaved,
             packed=packed,
+            softcap=softcap,
         )
         parity_check_gqa_past_no_buff(
             config,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rtol=5e-3,
             atol=5e-3,
             rotary=rotary,
             rotary_interleaved=rotary_interleaved,
             packed=packed,
+            softcap=softcap,
         )
 
 
@@ -1,4 +1,7 @@
+import dataclasses
+import logging
 import platform
+import random
 import unittest
 
 import torch
@@ -15,6 +18,8 @@ from test_gqa_cuda import (
 
 import onnxruntime
 
+logger = logging.getLogger(__name__)
+
 
 @unittest.skipIf(
     (not torch.cuda.is_available())
@@ -23,14 +28,21 @@ import onnxruntime
     reason="ROCm is not available, skipping tests.",
 )
 class TestRocmGQA(unittest.TestCase):
+    def setUp(self):
+        # Seeded per test so the random inputs and the batch given a full past in parity_check_gqa_past_no_buff do not
+        # depend on the test order.
+        random.seed(69)
+        torch.manual_seed(69)
+
     @parameterized.expand(gqa_no_past_flash_attention_test_cases())
-    def test_gqa_no_past_flash_attention(self, _, config, local, rotary, rotary_interleaved, packed, softcap):
-        config.ep = "ROCMExecutionProvider"
-        print("------- FLASH ATTENTION (PROMPT CASE) --------")
+    def test_gqa_no_past_flash_attention(self, _, config, window, rotary, rotary_interleaved, packed, softcap):
+        config = dataclasses.replace(config, ep="ROCMExecutionProvider")
+        logger.debug("FLASH ATTENTION (PROMPT CASE)")
 
         parity_check_gqa_prompt(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rotary=rotary,
             rotary_interleaved=rotary_interleaved,
@@ -41,7 +53,8 @@ class TestRocmGQA(unittest.TestCase):
 
         parity_check_gqa_prompt_no_buff(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rotary=rotary,
             rotary_interleaved=rotary_interleaved,
@@ -51,13 +64,14 @@ class TestRocmGQA(unittest.TestCase):
         )
 
     @parameterized.expand(gqa_past_flash_attention_test_cases())
-    def test_gqa_past_flash_attention(self, _, config, local, rotary, rotary_interleaved, packed, softcap):
-        config.ep = "ROCMExecutionProvider"
-        print("------- FLASH ATTENTION (TOKEN GEN) -------")
+    def test_gqa_past_flash_attention(self, _, config, window, rotary, rotary_interleaved, packed, softcap):
+        config = dataclasses.replace(config, ep="ROCMExecutionProvider")
+        logger.debug("FLASH ATTENTION (TOKEN GEN)")
 
         parity_check_gqa_past(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rotary=rotary,
             rotary_interleaved=rotary_interleaved,
@@ -67,7 +81,8 @@ class TestRocmGQA(unittest.TestCase):
         )
         parity_check_gqa_past_no_buff(
             config,
-            local=local,
+            local=window >= 0,
+            left_window_size=window,
             past_format=Formats.BNSH,
             rotary=rotary,
             rotary_interleaved=rotary_interleaved,